@@ -1,15 +1,23 @@
-from flask import Flask, jsonify, request
-from contextlib import closing
+from flask import Flask, Response, jsonify, request, stream_with_context
 from finbot.providers.factory import get_provider
+from finbot.providers import supports_single_pass
 from finbot.providers.errors import AuthFailure
+from finbot.providers.support.selenium import BrowserPool, DefaultBrowserFactory
+from finbot.providers.support.session_cache import SessionCache
 from finbot.apps.support import (
     request_handler,
     make_error_response,
-    make_error
+    make_error,
+    enable_compression
 )
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed, wait
+from datetime import timedelta
+import threading
 import traceback
 import logging.config
 import logging
+import json
+import os
 
 
 logging.config.dictConfig({
@@ -30,6 +38,102 @@ logging.config.dictConfig({
 
 
 app = Flask(__name__)
+enable_compression(app)
+
+
+def create_browser_pool():
+    max_size = int(os.environ.get("FINBOT_FINBOTWSRV_BROWSER_POOL_SIZE", 0))
+    if max_size < 1:
+        return None
+    pool = BrowserPool(
+        browser_factory=DefaultBrowserFactory(),
+        max_size=max_size,
+        min_size=int(os.environ.get("FINBOT_FINBOTWSRV_BROWSER_POOL_MIN_SIZE", 1)),
+        max_idle_time=timedelta(seconds=int(os.environ.get("FINBOT_FINBOTWSRV_BROWSER_MAX_IDLE", 600))),
+        max_uses=int(os.environ.get("FINBOT_FINBOTWSRV_BROWSER_MAX_USES", 20)))
+    logging.info(f"browser pool enabled (max_size={pool.max_size}, min_size={pool.min_size})")
+    pool.warm_up()
+    return pool
+
+
+browser_pool = create_browser_pool()
+
+
+def create_session_cache():
+    ttl = int(os.environ.get("FINBOT_FINBOTWSRV_SESSION_CACHE_TTL", 0))
+    if ttl < 1:
+        return None
+    with open(os.environ["FINBOT_SECRET_PATH"]) as secret_file:
+        secret = secret_file.read()
+    logging.info(f"provider session cache enabled (ttl={ttl}s)")
+    return SessionCache(secret, ttl=timedelta(seconds=ttl))
+
+
+session_cache = create_session_cache()
+line_item_timeout = int(os.environ.get("FINBOT_FINBOTWSRV_LINE_ITEM_TIMEOUT", 120))
+
+
+def restore_cached_session(provider_id, credentials_data, credentials, provider_api):
+    if not session_cache:
+        return False
+    try:
+        session_data = session_cache.get(provider_id, credentials_data)
+        if session_data is None:
+            return False
+        logging.info(f"restoring cached session for {credentials.user_id}")
+        if provider_api.restore_session(credentials, session_data):
+            return True
+        logging.info("cached session is no longer valid")
+    except Exception as e:
+        logging.warning(f"failed to restore cached session: {e}\n{traceback.format_exc()}")
+    session_cache.invalidate(provider_id, credentials_data)
+    return False
+
+
+def save_session(provider_id, credentials_data, provider_api):
+    if not session_cache:
+        return
+    try:
+        session_data = provider_api.export_session()
+        if session_data is not None:
+            session_cache.put(provider_id, credentials_data, session_data)
+    except Exception as e:
+        logging.warning(f"failed to export session: {e}\n{traceback.format_exc()}")
+
+
+class SinglePassProviderApi(object):
+    """ Serve all line items from a single 'get_financial_data' provider
+    call, performed on first access (success or failure is shared by all
+    line items)
+    """
+    def __init__(self, provider_api):
+        self._provider_api = provider_api
+        self._lock = threading.Lock()
+        self._fetched = False
+        self._financial_data = None
+        self._error = None
+
+    def _get(self, item_type):
+        with self._lock:
+            if not self._fetched:
+                logging.info("fetching all line items in one pass")
+                try:
+                    self._financial_data = self._provider_api.get_financial_data()
+                except Exception as e:
+                    self._error = e
+                self._fetched = True
+        if self._error is not None:
+            raise self._error
+        return self._financial_data.get(item_type, {"accounts": []})
+
+    def get_balances(self):
+        return self._get("balances")
+
+    def get_assets(self):
+        return self._get("assets")
+
+    def get_liabilities(self):
+        return self._get("liabilities")
 
 
 def balances_handler(provider_api):
@@ -88,6 +192,146 @@ def item_handler(item_type, provider_api):
         }
 
 
+def supports_concurrent_line_items(provider_api):
+    return type(provider_api).concurrent_line_items
+
+
+def timeout_error(line_item, timeout):
+    return {
+        "line_item": line_item,
+        "error": make_error(
+            user_message=f"failed to retrieve {line_item} line item",
+            debug_message=f"timeout after {timeout}s")
+    }
+
+
+def iter_line_items_concurrently(line_items, provider_api, timeout, running):
+    """ Yield line items results as soon as they are ready. Line items which
+    timed out are still running once done: their futures are added to
+    'running', the provider must not be closed before they complete.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(line_items), thread_name_prefix="line_item")
+    try:
+        futures = {
+            executor.submit(item_handler, line_item, provider_api): line_item
+            for line_item in line_items
+        }
+        handled = set()
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                handled.add(future)
+                yield future.result()
+        except TimeoutError:
+            for future, line_item in futures.items():
+                if future in handled:
+                    continue
+                if future.done():
+                    yield future.result()
+                    continue
+                logging.warning(f"timeout while handling '{line_item}' (after {timeout}s)")
+                running.append(future)
+                yield timeout_error(line_item, timeout)
+    finally:
+        # do not wait for line items which timed out
+        executor.shutdown(wait=False)
+
+
+def close_provider(provider_api, running):
+    """ Close the provider, once line items still 'running' are done with it
+    """
+    def close():
+        wait(running)
+        try:
+            provider_api.close()
+        except Exception as e:
+            logging.warning(f"failed to close provider: {e}\n{traceback.format_exc()}")
+
+    if not any(not future.done() for future in running):
+        provider_api.close()
+        return
+    logging.warning("provider will be closed once timed out line items are done")
+    threading.Thread(target=close, name="provider_close", daemon=True).start()
+
+
+def authentication_error(user_message, debug_message=None, trace=None):
+    return {
+        "auth": {"status": "failure"},
+        "error": make_error(user_message, debug_message, trace)
+    }
+
+
+def iter_financial_data(provider_id, provider, credentials_data, line_items):
+    """ Yield the authentication status first (along with an error when
+    authentication failed), then each line item as soon as it is ready
+    """
+    logging.info(f"initializing provider {provider_id}")
+    provider_kwargs = {"browser_factory": browser_pool} if browser_pool else {}
+    provider_api = provider.api_module.Api(**provider_kwargs)
+    running = []
+    try:
+        credentials = provider.api_module.Credentials.init(credentials_data)
+        restored = restore_cached_session(
+            provider_id, credentials_data, credentials, provider_api)
+        try:
+            if not restored:
+                logging.info(f"authenticating {credentials.user_id}")
+                provider_api.authenticate(credentials)
+        except AuthFailure as e:
+            logging.warning(f"authentication failure: {e}")
+            if session_cache:
+                session_cache.invalidate(provider_id, credentials_data)
+            yield authentication_error(
+                user_message=str(e),
+                debug_message=str(e),
+                trace=traceback.format_exc())
+            return
+        except Exception as e:
+            logging.warning(f"authentication failure: {e}")
+            yield authentication_error(
+                user_message="authentication failure (unknown error)",
+                debug_message=str(e),
+                trace=traceback.format_exc())
+            return
+
+        yield {"auth": {"status": "success"}}
+
+        if supports_single_pass(provider_api):
+            # all line items are served from the same provider call
+            line_items_source = SinglePassProviderApi(provider_api)
+            line_items_results = (
+                item_handler(line_item, line_items_source)
+                for line_item in line_items
+            )
+        elif len(line_items) > 1 and supports_concurrent_line_items(provider_api):
+            line_items_results = iter_line_items_concurrently(
+                line_items, provider_api, line_item_timeout, running)
+        else:
+            line_items_results = (
+                item_handler(line_item, provider_api)
+                for line_item in line_items
+            )
+
+        any_error = False
+        for entry in line_items_results:
+            any_error = any_error or "error" in entry
+            yield entry
+
+        if any_error:
+            if restored:
+                # restored session may have expired in the meantime
+                session_cache.invalidate(provider_id, credentials_data)
+        else:
+            # only sessions which served every line item are worth reusing
+            save_session(provider_id, credentials_data, provider_api)
+    finally:
+        close_provider(provider_api, running)
+
+
+def iter_ndjson(entries):
+    for entry in entries:
+        yield json.dumps(entry) + "\n"
+
+
 @app.route("/financial_data", methods=["POST"])
 @request_handler(schema={
     "type": "object",
@@ -100,32 +344,22 @@ def item_handler(item_type, provider_api):
     }
 })
 def get_financial_data():
+    stream = bool(int(request.args.get("stream", 0)))
     request_data = request.json
     provider_id = request_data["provider"]
     provider = get_provider(provider_id)
-    logging.info(f"initializing provider {provider_id}")
-    with closing(provider.api_module.Api()) as provider_api:
-        credentials = provider.api_module.Credentials.init(
-            request_data["credentials"])
-        try:
-            logging.info(f"authenticating {credentials.user_id}")
-            provider_api.authenticate(credentials)
-        except AuthFailure as e:
-            logging.warning(f"authentication failure: {e}")
-            return make_error_response(
-                user_message=str(e),
-                debug_message=str(e),
-                trace=traceback.format_exc())
-        except Exception as e:
-            logging.warning(f"authentication failure: {e}")
-            return make_error_response(
-                user_message="authentication failure (unknown error)",
-                debug_message=str(e),
-                trace=traceback.format_exc())
+    entries = iter_financial_data(
+        provider_id, provider, request_data["credentials"], list(set(request_data["items"])))
 
-        return jsonify({
-            "financial_data": [
-                item_handler(line_item, provider_api)
-                for line_item in set(request_data["items"])
-            ]
-        })
+    if stream:
+        # one JSON document per line: authentication status, then line items
+        return Response(
+            stream_with_context(iter_ndjson(entries)),
+            mimetype="application/x-ndjson")
+
+    auth_status = next(entries)
+    if "error" in auth_status:
+        return make_error_response(**auth_status["error"])
+    return jsonify({
+        "financial_data": list(entries)
+    })
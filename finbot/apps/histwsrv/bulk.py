@@ -0,0 +1,39 @@
+import pandas as pd
+import logging
+import io
+
+
+def _copy_frame(db_session, table, frame: pd.DataFrame):
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False, na_rep="\\N")
+    buffer.seek(0)
+    columns = ", ".join(frame.columns)
+    dbapi_connection = db_session.connection().connection
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer)
+
+
+def allocate_ids(db_session, table, count):
+    """ Reserve 'count' values of 'table' serial primary key, so that rows
+    referencing them can be bulk inserted in the same transaction
+    """
+    if count == 0:
+        return []
+    rows = db_session.execute(
+        f"SELECT nextval(pg_get_serial_sequence('{table.name}', 'id'))"
+        f" FROM generate_series(1, :count)",
+        {"count": count})
+    return [row[0] for row in rows]
+
+
+def write_frame(db_session, table, frame: pd.DataFrame):
+    """ Write all rows of 'frame' (columns named after 'table' columns)
+    with COPY FROM STDIN, without building ORM entities. Does not commit.
+    """
+    if frame.empty:
+        return 0
+    _copy_frame(db_session, table, frame)
+    logging.info(f"bulk inserted {len(frame)} row(s) in {table.name}")
+    return len(frame)
@@ -1,8 +1,8 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
-from finbot.apps.support import request_handler
-from finbot.apps.histwsrv import repository
+from finbot.apps.support import request_handler, enable_compression
+from finbot.apps.histwsrv import repository, valuation, bulk
 from finbot.core.utils import serialize, pretty_dump
 from finbot.core import dbutils
 from finbot.model import (
@@ -11,7 +11,8 @@ from finbot.model import (
     UserAccountValuationHistoryEntry,
     LinkedAccountValuationHistoryEntry,
     SubAccountValuationHistoryEntry,
-    SubAccountItemValuationHistoryEntry
+    SubAccountItemValuationHistoryEntry,
+    ValuationChangeEntry
 )
 import pandas as pd
 import logging.config
@@ -39,55 +40,12 @@ logging.config.dictConfig({
 db_engine = create_engine(os.environ['FINBOT_DB_URL'])
 db_session = dbutils.add_persist_utilities(scoped_session(sessionmaker(bind=db_engine)))
 
-app = Flask(__name__)
-
-
-def get_user_account_valuation(data: pd.DataFrame):
-    return data["value_snapshot_ccy"].sum()
-
-
-def get_user_account_liabilities(data: pd.DataFrame):
-    return data.loc[data["value_snapshot_ccy"] < 0, "value_snapshot_ccy"].sum()
-
-
-def get_linked_accounts_valuation(data: pd.DataFrame):
-    groups = ["linked_account_id", "snapshot_id"]
-    return (data.groupby(groups)["value_snapshot_ccy"]
-                .sum()
-                .to_dict())
-
-
-def get_sub_accounts_valuation(data: pd.DataFrame):
-    groups = [
-        "linked_account_id", 
-        "sub_account_id",
-        "sub_account_ccy",
-        "sub_account_description"
-    ]
-    data = (data.groupby(groups)
-                .agg({
-                    "value_sub_account_ccy": "sum",
-                    "value_snapshot_ccy": "sum"
-                }).to_dict())
-    sub_account_data = data["value_sub_account_ccy"]
-    snapshot_data = data["value_snapshot_ccy"]
-    return {
-        path: (value, sub_account_data[path])
-        for path, value in snapshot_data.items()
-    }
+# pipeline mode (see 'write_history_pipeline') is used unless overridden by
+# the 'pipeline' request argument
+pipeline_mode = bool(int(os.environ.get("FINBOT_HISTWSRV_PIPELINE", 0)))
 
-
-def iter_sub_accounts_valuation_history_entries(data: pd.DataFrame):
-    for _, row in data.iterrows():
-        yield SubAccountItemValuationHistoryEntry(
-            linked_account_id=row["linked_account_id"],
-            sub_account_id=row["sub_account_id"],
-            item_type=row["item_type"],
-            name=row["item_name"],
-            item_subtype=row["item_subtype"],
-            units=row["item_units"],
-            valuation=row["value_snapshot_ccy"],
-            valuation_sub_account_ccy=row["value_sub_account_ccy"])
+app = Flask(__name__)
+enable_compression(app)
 
 
 @app.teardown_appcontext
@@ -95,30 +53,25 @@ def cleanup_context(*args, **kwargs):
     db_session.remove()
 
 
-@app.route("/history/<snapshot_id>/write", methods=["POST"])
-@request_handler()
-def write_history(snapshot_id):
-    repo = repository.ReportRepository(db_session)
+def supersede_history_entries(history_entry):
+    """ History entries previously written for the same snapshot (replayed
+    snapshot) are superseded by this one. Does not commit.
+    """
+    (db_session.query(UserAccountHistoryEntry)
+               .filter(UserAccountHistoryEntry.source_snapshot_id == history_entry.source_snapshot_id)
+               .filter(UserAccountHistoryEntry.id != history_entry.id)
+               .update({UserAccountHistoryEntry.available: False},
+                       synchronize_session=False))
 
-    logging.info("fetching snapshot_id={} metadata".format(snapshot_id))
-    snapshot = (db_session.query(UserAccountSnapshot)
-                          .filter_by(id=snapshot_id)
-                          .first())
 
+def write_history_incremental(repo, snapshot, snapshot_data):
     valuation_date = snapshot.end_time
-    logging.info(f"snapshot is effective_at={valuation_date}")
-    logging.info(f"fetching consistent snapshot")
-
-    snapshot_data = repo.get_consistent_snapshot_data(snapshot_id)
-
-    logging.debug(snapshot_data.to_csv())
 
-    logging.info(f"consistent snapshot has entries={len(snapshot_data)}")
     logging.info(f"creating new history entry (marked not available)")
 
     with db_session.persist(UserAccountHistoryEntry()) as history_entry:
         history_entry.user_account_id = snapshot.user_account_id
-        history_entry.source_snapshot_id = snapshot_id
+        history_entry.source_snapshot_id = snapshot.id
         history_entry.effective_at = valuation_date
         history_entry.valuation_ccy = snapshot.requested_ccy
         history_entry.user_account_id = snapshot.user_account_id
@@ -128,10 +81,10 @@ def write_history(snapshot_id):
 
     logging.info(f"handling basic valuation")
 
-    user_account_valuation = get_user_account_valuation(snapshot_data)
+    user_account_valuation = valuation.get_user_account_valuation(snapshot_data)
     logging.info(f"user account valuation {user_account_valuation}")
 
-    user_account_total_liabilities = get_user_account_liabilities(snapshot_data)
+    user_account_total_liabilities = valuation.get_user_account_liabilities(snapshot_data)
     logging.info(f"user account liabilities {user_account_total_liabilities}")
 
     with db_session.persist(history_entry):
@@ -139,46 +92,26 @@ def write_history(snapshot_id):
             valuation=user_account_valuation,
             total_liabilities=user_account_total_liabilities)
 
-    linked_accounts_valuation = get_linked_accounts_valuation(snapshot_data)
-    logging.info(f"fetched linked accounts valuation")
-    logging.debug(pretty_dump(linked_accounts_valuation))
-
-    with db_session.persist(history_entry):
-        history_entry.linked_accounts_valuation_history_entries.extend([
-            LinkedAccountValuationHistoryEntry(
-                linked_account_id=linked_account_id,
-                effective_snapshot_id=effective_snapshot_id,
-                valuation=valuation
-            )
-            for (linked_account_id, effective_snapshot_id), valuation 
-            in linked_accounts_valuation.items()
-        ])
-
-    sub_accounts_valuation = get_sub_accounts_valuation(snapshot_data)
-    logging.info(f"fetched sub accounts valuation")
-    logging.debug(pretty_dump(sub_accounts_valuation))
+    # history rows are built column-wise from the snapshot data and bulk
+    # inserted (no ORM entity per row)
+    history_frames = [
+        (LinkedAccountValuationHistoryEntry,
+         valuation.get_linked_accounts_valuation_frame(snapshot_data)),
+        (SubAccountValuationHistoryEntry,
+         valuation.get_sub_accounts_valuation_frame(snapshot_data)),
+        (SubAccountItemValuationHistoryEntry,
+         valuation.get_sub_accounts_items_valuation_frame(snapshot_data))
+    ]
 
     with db_session.persist(history_entry):
-        history_entry.sub_accounts_valuation_history_entries.extend([
-            SubAccountValuationHistoryEntry(
-                linked_account_id=linked_account_id,
-                sub_account_id=sub_account_id,
-                sub_account_ccy=sub_account_ccy,
-                sub_account_description=sub_account_description,
-                valuation=snapshot_valuation,
-                valuation_sub_account_ccy=account_valuation
-            )
-            for (linked_account_id, 
-                 sub_account_id, 
-                 sub_account_ccy, 
-                 sub_account_description), 
-                (snapshot_valuation, account_valuation)
-            in sub_accounts_valuation.items()
-        ])
+        for entity, frame in history_frames:
+            logging.debug(frame.to_csv())
+            bulk.write_frame(
+                db_session,
+                entity.__table__,
+                frame.assign(history_entry_id=history_entry.id))
 
-    with db_session.persist(history_entry):
-        history_entry.sub_accounts_items_valuation_history_entries.extend(
-            list(iter_sub_accounts_valuation_history_entries(snapshot_data)))
+    logging.info(f"linked accounts, sub accounts and items valuation written")
 
     logging.info(f"handling valuation change calculations")
 
@@ -237,8 +170,123 @@ def write_history(snapshot_id):
 
     with db_session.persist(history_entry):
         history_entry.available = True
+        supersede_history_entries(history_entry)
+
+    return history_entry, user_account_valuation
+
+
+def write_history_pipeline(repo, snapshot, snapshot_data):
+    """ Compute every valuation and valuation change in memory (from the
+    snapshot data and the reference history entries valuations), then write
+    the whole history entry in a single transaction: the entry is made
+    available by the same commit.
+    """
+    valuation_date = snapshot.end_time
+
+    reference_history_entry_ids = repo.get_reference_history_entry_ids(
+        baseline_id=None,
+        user_account_id=snapshot.user_account_id,
+        valuation_date=valuation_date)
+
+    logging.info("reference history entry ids")
+    logging.debug(pretty_dump(reference_history_entry_ids))
+
+    reference_entry_ids = repository.get_reference_entry_ids(reference_history_entry_ids)
+
+    def get_valuation_changes(level, baseline_valuations):
+        # snapshot data values are float64, reference valuations are decimals
+        reference_valuations = {
+            history_entry_id: {key: float(value) for key, value in valuations.items()}
+            for history_entry_id, valuations in repo.get_valuations(level, reference_entry_ids).items()
+        }
+        return repository.compute_valuation_changes(
+            baseline_valuations,
+            reference_valuations,
+            reference_history_entry_ids)
+
+    user_account_valuation = valuation.get_user_account_valuation(snapshot_data)
+    logging.info(f"user account valuation {user_account_valuation}")
+
+    user_account_total_liabilities = valuation.get_user_account_liabilities(snapshot_data)
+    logging.info(f"user account liabilities {user_account_total_liabilities}")
+
+    user_account_valuation_change = get_valuation_changes(
+        repository.USER_ACCOUNT_LEVEL, {(): user_account_valuation})[()]
+
+    history_entry = UserAccountHistoryEntry(
+        user_account_id=snapshot.user_account_id,
+        source_snapshot_id=snapshot.id,
+        effective_at=valuation_date,
+        valuation_ccy=snapshot.requested_ccy,
+        available=False)
+    history_entry.user_account_valuation_history_entry = UserAccountValuationHistoryEntry(
+        valuation=user_account_valuation,
+        total_liabilities=user_account_total_liabilities,
+        valuation_change=ValuationChangeEntry(**user_account_valuation_change))
+    db_session.add(history_entry)
+    db_session.flush()
+
+    logging.info(f"history entry created with id={history_entry.id} (not committed)")
+
+    history_frames = [
+        (LinkedAccountValuationHistoryEntry,
+         repository.LINKED_ACCOUNTS_LEVEL,
+         valuation.get_linked_accounts_valuation_frame(snapshot_data)),
+        (SubAccountValuationHistoryEntry,
+         repository.SUB_ACCOUNTS_LEVEL,
+         valuation.get_sub_accounts_valuation_frame(snapshot_data)),
+        (SubAccountItemValuationHistoryEntry,
+         repository.SUB_ACCOUNTS_ITEMS_LEVEL,
+         valuation.get_sub_accounts_items_valuation_frame(snapshot_data))
+    ]
+
+    change_table = ValuationChangeEntry.__table__
+    for entity, level, frame in history_frames:
+        frame_valuations = valuation.get_frame_valuations(
+            frame, [column for _, column in level.key_columns])
+        changes = get_valuation_changes(level, frame_valuations)
+        change_ids = bulk.allocate_ids(db_session, change_table, len(frame))
+        changes_frame = pd.DataFrame.from_records(
+            [changes[key] for key in frame_valuations.keys()],
+            columns=[change_name for _, change_name, _ in repository.VALUATION_CHANGE_HORIZONS])
+        bulk.write_frame(db_session, change_table, changes_frame.assign(id=change_ids))
+        bulk.write_frame(
+            db_session,
+            entity.__table__,
+            frame.assign(history_entry_id=history_entry.id, valuation_change_id=change_ids))
+
+    history_entry.available = True
+    supersede_history_entries(history_entry)
+    db_session.commit()
+
+    return history_entry, user_account_valuation
+
+
+@app.route("/history/<snapshot_id>/write", methods=["POST"])
+@request_handler()
+def write_history(snapshot_id):
+    run_pipeline = bool(int(request.args.get("pipeline", pipeline_mode)))
+    repo = repository.ReportRepository(db_session)
+
+    logging.info("fetching snapshot_id={} metadata".format(snapshot_id))
+    snapshot = (db_session.query(UserAccountSnapshot)
+                          .filter_by(id=snapshot_id)
+                          .first())
+
+    valuation_date = snapshot.end_time
+    logging.info(f"snapshot is effective_at={valuation_date}")
+    logging.info(f"fetching consistent snapshot")
+
+    snapshot_data = repo.get_consistent_snapshot_data(snapshot_id)
+
+    logging.debug(snapshot_data.to_csv())
+
+    logging.info(f"consistent snapshot has entries={len(snapshot_data)}")
+
+    writer = write_history_pipeline if run_pipeline else write_history_incremental
+    history_entry, user_account_valuation = writer(repo, snapshot, snapshot_data)
 
-    logging.info("new history entry added and enabled successfully")
+    logging.info(f"new history entry added and enabled successfully (pipeline={run_pipeline})")
 
     return jsonify(serialize({
         "report": {
@@ -1,335 +1,309 @@
 from finbot.model import ValuationChangeEntry
+from sqlalchemy import text
+from pandas.api.types import union_categoricals
+from collections import defaultdict
 import pandas as pd
+import numpy as np
+
+
+# (reference history entry id key, valuation change column, lookback as a
+# postgres interval), see ReportRepository.get_reference_history_entry_ids
+VALUATION_CHANGE_HORIZONS = [
+    ("change_1h_id", "change_1hour", "1 hour"),
+    ("change_1d_id", "change_1day", "1 day"),
+    ("change_1w_id", "change_1week", "1 week"),
+    ("change_1m_id", "change_1month", "1 month"),
+    ("change_6m_id", "change_6months", "6 months"),
+    ("change_1y_id", "change_1year", "1 year"),
+    ("change_2y_id", "change_2years", "2 years"),
+]
+
+
+class ColumnKind(object):
+    Id = "id"  # int64
+    Category = "category"
+    Text = "text"
+    Value = "value"  # float64
+
+
+CONSISTENT_SNAPSHOT_COLUMNS = [
+    ("snapshot_id", ColumnKind.Id),
+    ("linked_account_snapshot_entry_id", ColumnKind.Id),
+    ("linked_account_id", ColumnKind.Category),
+    ("sub_account_id", ColumnKind.Category),
+    ("sub_account_ccy", ColumnKind.Category),
+    ("sub_account_description", ColumnKind.Category),
+    ("sub_account_snapshot_entry_id", ColumnKind.Id),
+    ("sub_account_item_snapshot_entry_id", ColumnKind.Id),
+    ("item_name", ColumnKind.Text),
+    ("item_type", ColumnKind.Category),
+    ("item_subtype", ColumnKind.Category),
+    ("item_units", ColumnKind.Value),
+    ("value_snapshot_ccy", ColumnKind.Value),
+    ("value_sub_account_ccy", ColumnKind.Value),
+]
+
+
+CONSISTENT_SNAPSHOT_QUERY = """
+        SELECT slas.snapshot_id AS snapshot_id,
+               las.id AS linked_account_snapshot_entry_id,
+               slas.linked_account_id AS linked_account_id,
+               sase.sub_account_id AS sub_account_id,
+               sase.sub_account_ccy AS sub_account_ccy,
+               sase.sub_account_description AS sub_account_description,
+               sais.sub_account_snapshot_entry_id AS sub_account_snapshot_entry_id,
+               sais.id AS sub_account_item_snapshot_entry_id,
+               sais.name AS item_name,
+               sais.item_type AS item_type,
+               sais.item_subtype AS item_subtype,
+               sais.units AS item_units,
+               CASE
+                   WHEN las.reference_entry_id IS NULL
+                   THEN sais.value_snapshot_ccy
+                   WHEN sase.sub_account_ccy = uas.requested_ccy
+                   THEN sais.value_sub_account_ccy
+                   ELSE sais.value_sub_account_ccy * xrs.rate
+               END AS value_snapshot_ccy,
+               sais.value_sub_account_ccy AS value_sub_account_ccy
+        FROM (
+            -- Find the latest linked account snapshot entry in a
+            -- successful snapshot (can be the requested raw snapshot or any
+            -- that was taken before) for each linked account belonging
+            -- to the user.
+
+            SELECT las.linked_account_id AS linked_account_id,
+                   MAX(las.snapshot_id) AS snapshot_id
+            FROM finbot_linked_accounts_snapshots las
+            JOIN (
+                -- Find all active linked accounts owned by the user 
+                -- the requested raw snapshot was created for.
+
+                SELECT la.id FROM finbot_linked_accounts la
+                JOIN finbot_user_accounts_snapshots uas 
+                ON uas.user_account_id = la.user_account_id 
+                WHERE uas.id = :snapshot_id
+                AND NOT deleted
+            ) AS la ON la.id = las.linked_account_id
+            WHERE success
+            AND las.snapshot_id <= :snapshot_id
+            GROUP BY las.linked_account_id
+        ) AS slas
+        JOIN finbot_linked_accounts_snapshots las
+          ON las.snapshot_id = slas.snapshot_id
+         AND las.linked_account_id = slas.linked_account_id
+        JOIN finbot_user_accounts_snapshots uas
+          ON uas.id = las.snapshot_id
+
+        -- Linked account entries unchanged since a previous snapshot
+        -- reference the entry holding sub accounts and items: values
+        -- are converted with the referencing snapshot rates.
+
+        JOIN finbot_sub_accounts_snapshot_entries sase 
+          ON sase.linked_account_snapshot_entry_id = COALESCE(las.reference_entry_id, las.id)
+        JOIN finbot_sub_accounts_items_snapshot_entries sais 
+          ON sais.sub_account_snapshot_entry_id = sase.id
+        LEFT JOIN finbot_xccy_rates_snapshots xrs
+          ON xrs.snapshot_id = las.snapshot_id
+         AND xrs.xccy_pair = sase.sub_account_ccy || uas.requested_ccy
+"""
+
+
+def _get_column_expression(column, kind):
+    if kind != ColumnKind.Value:
+        return f"snapshot_data.{column}"
+    return f"CAST(snapshot_data.{column} AS DOUBLE PRECISION)"
+
+
+def _make_column(values, kind):
+    if kind == ColumnKind.Id:
+        return np.array(values, dtype=np.int64)
+    if kind == ColumnKind.Category:
+        return pd.Categorical(values)
+    if kind == ColumnKind.Text:
+        return np.array(values, dtype=object)
+    return np.array(values, dtype=np.float64)
+
+
+def _concat_column(chunks, kind):
+    if not chunks:
+        return pd.Series(_make_column([], kind))
+    if kind == ColumnKind.Category:
+        return pd.Series(union_categoricals(chunks))
+    return pd.concat([pd.Series(chunk) for chunk in chunks], ignore_index=True)
+
+
+class ValuationLevel(object):
+    """ Valuation history table, entries are identified by 'key_columns'
+    ((alias, column) pairs) within a history entry
+    """
+    def __init__(self, table, key_columns):
+        self.table = table
+        self.key_columns = key_columns
+
+
+USER_ACCOUNT_LEVEL = ValuationLevel(
+    "finbot_user_accounts_valuation_history_entries", [])
+
+LINKED_ACCOUNTS_LEVEL = ValuationLevel(
+    "finbot_linked_accounts_valuation_history_entries",
+    [("linked_account_id", "linked_account_id")])
+
+SUB_ACCOUNTS_LEVEL = ValuationLevel(
+    "finbot_sub_accounts_valuation_history_entries",
+    [("linked_account_id", "linked_account_id"),
+     ("sub_account_id", "sub_account_id")])
+
+SUB_ACCOUNTS_ITEMS_LEVEL = ValuationLevel(
+    "finbot_sub_accounts_items_valuation_history_entries",
+    [("linked_account_id", "linked_account_id"),
+     ("sub_account_id", "sub_account_id"),
+     ("item_type", "item_type"),
+     ("item_name", "name")])
+
+
+def get_reference_entry_ids(reference_ids):
+    return [
+        reference_ids[reference_key]
+        for reference_key, _, _ in VALUATION_CHANGE_HORIZONS
+        if reference_ids.get(reference_key) is not None
+    ]
+
+
+def compute_valuation_changes(baseline_valuations, reference_valuations, reference_ids):
+    """ Valuation change (change column -> value, for each horizon) of each
+    baseline entry (key -> valuation). 'reference_valuations' holds
+    valuations of the reference history entries (history entry id -> key ->
+    valuation), see ReportRepository.get_valuations
+    """
+    horizons = [
+        (change_name, reference_valuations.get(reference_ids.get(reference_key), {}))
+        for reference_key, change_name, _ in VALUATION_CHANGE_HORIZONS
+    ]
+    return {
+        key: {
+            change_name: (valuation - references[key] if key in references else None)
+            for change_name, references in horizons
+        }
+        for key, valuation in baseline_valuations.items()
+    }
 
 
 class ReportRepository(object):
     def __init__(self, db_session):
         self.db_session = db_session
 
-    def get_consistent_snapshot_data(self, snapshot_id):
-        query = """
-            SELECT slas.snapshot_id AS snapshot_id,
-                   sase.linked_account_snapshot_entry_id AS linked_account_snapshot_entry_id,
-                   slas.linked_account_id AS linked_account_id,
-                   sase.sub_account_id AS sub_account_id,
-                   sase.sub_account_ccy AS sub_account_ccy,
-                   sase.sub_account_description AS sub_account_description,
-                   sais.sub_account_snapshot_entry_id AS sub_account_snapshot_entry_id,
-                   sais.id AS sub_account_item_snapshot_entry_id,
-                   sais.name AS item_name,
-                   sais.item_type AS item_type,
-                   sais.item_subtype AS item_subtype,
-                   sais.units AS item_units,
-                   sais.value_snapshot_ccy AS value_snapshot_ccy,
-                   sais.value_sub_account_ccy AS value_sub_account_ccy
-            FROM (
-                -- Find the latest linked account snapshot entry in a
-                -- successful snapshot (can be the requested raw snapshot or any
-                -- that was taken before) for each linked account belonging
-                -- to the user.
-
-                SELECT las.linked_account_id AS linked_account_id,
-                       MAX(las.snapshot_id) AS snapshot_id
-                FROM finbot_linked_accounts_snapshots las
-                JOIN (
-                    -- Find all active linked accounts owned by the user 
-                    -- the requested raw snapshot was created for.
-
-                    SELECT la.id FROM finbot_linked_accounts la
-                    JOIN finbot_user_accounts_snapshots uas 
-                    ON uas.user_account_id = la.user_account_id 
-                    WHERE uas.id = :snapshot_id
-                    AND NOT deleted
-                ) AS la ON la.id = las.linked_account_id
-                WHERE success
-                AND las.snapshot_id <= :snapshot_id
-                GROUP BY las.linked_account_id
-            ) AS slas
-            JOIN finbot_linked_accounts_snapshots las
-              ON las.snapshot_id = slas.snapshot_id
-             AND las.linked_account_id = slas.linked_account_id
-            JOIN finbot_sub_accounts_snapshot_entries sase 
-              ON sase.linked_account_snapshot_entry_id = las.id
-            JOIN finbot_sub_accounts_items_snapshot_entries sais 
-              ON sais.sub_account_snapshot_entry_id = sase.id
+    def get_consistent_snapshot_data(self, snapshot_id, chunk_size=10000):
+        """ Consistent snapshot data, streamed from the database in chunks of
+        'chunk_size' rows into typed columns (see CONSISTENT_SNAPSHOT_COLUMNS).
+        Values (and units) are converted to float64 by the database.
         """
-        results = self.db_session.execute(query, {"snapshot_id": snapshot_id})
-        return pd.DataFrame([dict(row) for row in results])
+        query = "SELECT {} FROM ({}) AS snapshot_data".format(
+            ", ".join(
+                f"{_get_column_expression(column, kind)} AS {column}"
+                for column, kind in CONSISTENT_SNAPSHOT_COLUMNS),
+            CONSISTENT_SNAPSHOT_QUERY)
+        params = {"snapshot_id": snapshot_id}
+        connection = self.db_session.connection().execution_options(stream_results=True)
+        results = connection.execute(text(query), params)
+        chunks = [[] for _ in CONSISTENT_SNAPSHOT_COLUMNS]
+        while True:
+            rows = results.fetchmany(chunk_size)
+            if not rows:
+                break
+            for index, values in enumerate(zip(*rows)):
+                kind = CONSISTENT_SNAPSHOT_COLUMNS[index][1]
+                chunks[index].append(_make_column(values, kind))
+        results.close()
+        return pd.DataFrame({
+            column: _concat_column(column_chunks, kind)
+            for (column, kind), column_chunks in zip(CONSISTENT_SNAPSHOT_COLUMNS, chunks)
+        })
 
-    def get_reference_history_entry_ids(self, baseline_id, user_account_id, 
-                                        valuation_date):
+    def get_reference_history_entry_ids(self, baseline_id, user_account_id, valuation_date):
         """ Return user account history entry identifiers for different 'reference'
-        dates in the past (1 day, 1 month, 6 months, 1 year, 2 years)
+        dates in the past (see VALUATION_CHANGE_HORIZONS). All horizons are
+        looked up in a single query, each with one backward scan of the
+        (user_account_id, effective_at) partial index.
         """
         query = """
-            SELECT c1h.id AS change_1h_id,
-                   c1d.id AS change_1d_id,
-                   c1w.id AS change_1w_id,
-                   c1m.id AS change_1m_id,
-                   c6m.id AS change_6m_id,
-                   c1y.id AS change_1y_id,
-                   c2y.id AS change_2y_id
-            FROM (VALUES (1)) AS dummy (pk)
-            LEFT JOIN (
-                SELECT 1 AS pk, id
-                FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '1 hour')
-                AND user_account_id = :user_account_id
-                AND available
-                ORDER BY effective_at DESC
-                LIMIT 1
-            ) AS c1h ON dummy.pk = c1h.pk
-            LEFT JOIN (
-                SELECT 1 AS pk, id
-                FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '1 day')
-                AND user_account_id = :user_account_id
-                AND available
-                ORDER BY effective_at DESC
-                LIMIT 1
-            ) AS c1d ON dummy.pk = c1d.pk
-            LEFT JOIN (
-                SELECT 1 AS pk, id
-                FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '1 week')
-                AND user_account_id = :user_account_id
-                AND available
-                ORDER BY effective_at DESC
-                LIMIT 1
-            ) AS c1w ON dummy.pk = c1w.pk
-            LEFT JOIN (
-                SELECT 1 AS pk, id
-                FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '1 month')
-                AND user_account_id = :user_account_id
-                AND available
-                ORDER BY effective_at DESC
-                LIMIT 1
-            ) AS c1m ON dummy.pk = c1m.pk
-            LEFT JOIN (
-                SELECT 1 AS pk, id
-                FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '6 months')
-                AND user_account_id = :user_account_id
-                AND available
-                ORDER BY effective_at DESC
-                LIMIT 1
-            ) AS c6m ON dummy.pk = c6m.pk
-            LEFT JOIN (
-                SELECT 1 AS pk, id
-                FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '1 year')
-                AND user_account_id = :user_account_id
-                AND available
-                ORDER BY effective_at DESC
-                LIMIT 1
-            ) AS c1y ON dummy.pk = c1y.pk
-            LEFT JOIN (
-                SELECT 1 AS pk, id
+            SELECT horizon.reference_key AS reference_key,
+                   reference_entry.id AS history_entry_id
+            FROM unnest(CAST(:reference_keys AS text[]),
+                        CAST(:lookbacks AS interval[])) AS horizon (reference_key, lookback)
+            LEFT JOIN LATERAL (
+                SELECT id
                 FROM finbot_user_accounts_history_entries
-                WHERE effective_at <= (:valuation_date - INTERVAL '2 years')
-                AND user_account_id = :user_account_id
+                WHERE user_account_id = :user_account_id
                 AND available
+                AND effective_at <= (:valuation_date - horizon.lookback)
                 ORDER BY effective_at DESC
                 LIMIT 1
-            ) AS c2y ON dummy.pk = c2y.pk
+            ) AS reference_entry ON TRUE
         """
         results = self.db_session.execute(query, {
+            "reference_keys": [reference_key for reference_key, _, _ in VALUATION_CHANGE_HORIZONS],
+            "lookbacks": [lookback for _, _, lookback in VALUATION_CHANGE_HORIZONS],
             "user_account_id": user_account_id,
             "valuation_date": valuation_date
         })
-        past_results = dict(next(results))
+        past_results = {
+            row["reference_key"]: row["history_entry_id"]
+            for row in results
+        }
         past_results["baseline_id"] = baseline_id
         return past_results
 
-    def get_user_account_valuation_change(self, reference_ids):
-        query = """
-            SELECT val.valuation - val_c1h.valuation AS change_1hour,
-                   val.valuation - val_c1d.valuation AS change_1day,
-                   val.valuation - val_c1w.valuation AS change_1week,
-                   val.valuation - val_c1m.valuation AS change_1month,
-                   val.valuation - val_c6m.valuation AS change_6months,
-                   val.valuation - val_c1y.valuation AS change_1year,
-                   val.valuation - val_c2y.valuation AS change_2years
-              FROM finbot_user_accounts_valuation_history_entries val
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c1h
-                ON val_c1h.history_entry_id = :change_1h_id
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c1d
-                ON val_c1d.history_entry_id = :change_1d_id
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c1w
-                ON val_c1w.history_entry_id = :change_1w_id
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c1m
-                ON val_c1m.history_entry_id = :change_1m_id
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c6m
-                ON val_c6m.history_entry_id = :change_6m_id
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c1y
-                ON val_c1y.history_entry_id = :change_1y_id
-         LEFT JOIN finbot_user_accounts_valuation_history_entries val_c2y
-                ON val_c2y.history_entry_id = :change_2y_id
-             WHERE val.history_entry_id = :baseline_id
+    def get_valuations(self, level: ValuationLevel, history_entry_ids):
+        """ Valuations (history entry id -> key -> valuation) of all entries
+        of the given valuation history entries, fetched with a single scan of
+        the history_entry_id leading primary key index
         """
-        row = next(self.db_session.execute(query, reference_ids))
-        return ValuationChangeEntry(**dict(row))
-
-    def get_linked_accounts_valuation_change(self, reference_ids):
-        query = """
-            SELECT val.linked_account_id AS linked_account_id,
-                   val.valuation - val_c1h.valuation AS change_1hour,
-                   val.valuation - val_c1d.valuation AS change_1day,
-                   val.valuation - val_c1w.valuation AS change_1week,
-                   val.valuation - val_c1m.valuation AS change_1month,
-                   val.valuation - val_c6m.valuation AS change_6months,
-                   val.valuation - val_c1y.valuation AS change_1year,
-                   val.valuation - val_c2y.valuation AS change_2years
-              FROM finbot_linked_accounts_valuation_history_entries val
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c1h
-                ON val_c1h.linked_account_id = val.linked_account_id
-               AND val_c1h.history_entry_id = :change_1h_id
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c1d
-                ON val_c1d.linked_account_id = val.linked_account_id
-               AND val_c1d.history_entry_id = :change_1d_id
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c1w
-                ON val_c1w.linked_account_id = val.linked_account_id
-               AND val_c1w.history_entry_id = :change_1w_id
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c1m
-                ON val_c1m.linked_account_id = val.linked_account_id
-               AND val_c1m.history_entry_id = :change_1m_id
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c6m
-                ON val_c6m.linked_account_id = val.linked_account_id
-               AND val_c6m.history_entry_id = :change_6m_id
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c1y
-                ON val_c1y.linked_account_id = val.linked_account_id
-               AND val_c1y.history_entry_id = :change_1y_id
-         LEFT JOIN finbot_linked_accounts_valuation_history_entries val_c2y
-                ON val_c2y.linked_account_id = val.linked_account_id
-               AND val_c2y.history_entry_id = :change_2y_id
-             WHERE val.history_entry_id = :baseline_id
+        selected_columns = (
+            ["val.history_entry_id AS history_entry_id"] +
+            [f"val.{column} AS {alias}" for alias, column in level.key_columns] +
+            ["val.valuation AS valuation"]
+        )
+        query = f"""
+            SELECT {", ".join(selected_columns)}
+              FROM {level.table} val
+             WHERE val.history_entry_id = ANY(:history_entry_ids)
         """
-        rows = self.db_session.execute(query, reference_ids)
-        results = {}
+        valuations = defaultdict(dict)
+        if not history_entry_ids:
+            return valuations
+        rows = self.db_session.execute(query, {"history_entry_ids": list(history_entry_ids)})
         for row in rows:
-            row = dict(row)
-            results[row["linked_account_id"]] = ValuationChangeEntry(
-                **({k: v for k, v in row.items() if k.startswith("change_")}))
-        return results
+            key = tuple(row[alias] for alias, _ in level.key_columns)
+            valuations[row["history_entry_id"]][key] = row["valuation"]
+        return valuations
 
-    def get_sub_accounts_valuation_change(self, reference_ids):
-        query = """
-            SELECT val.linked_account_id AS linked_account_id,
-                   val.sub_account_id AS sub_account_id,
-                   val.valuation - val_c1h.valuation AS change_1hour,
-                   val.valuation - val_c1d.valuation AS change_1day,
-                   val.valuation - val_c1w.valuation AS change_1week,
-                   val.valuation - val_c1m.valuation AS change_1month,
-                   val.valuation - val_c6m.valuation AS change_6months,
-                   val.valuation - val_c1y.valuation AS change_1year,
-                   val.valuation - val_c2y.valuation AS change_2years
-              FROM finbot_sub_accounts_valuation_history_entries val
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c1h
-                ON val_c1h.linked_account_id = val.linked_account_id
-               AND val_c1h.sub_account_id = val.sub_account_id
-               AND val_c1h.history_entry_id = :change_1h_id
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c1d
-                ON val_c1d.linked_account_id = val.linked_account_id
-               AND val_c1d.sub_account_id = val.sub_account_id
-               AND val_c1d.history_entry_id = :change_1d_id
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c1w
-                ON val_c1w.linked_account_id = val.linked_account_id
-               AND val_c1w.sub_account_id = val.sub_account_id
-               AND val_c1w.history_entry_id = :change_1w_id
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c1m
-                ON val_c1m.linked_account_id = val.linked_account_id
-               AND val_c1m.sub_account_id = val.sub_account_id
-               AND val_c1m.history_entry_id = :change_1m_id
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c6m
-                ON val_c6m.linked_account_id = val.linked_account_id
-               AND val_c6m.sub_account_id = val.sub_account_id
-               AND val_c6m.history_entry_id = :change_6m_id
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c1y
-                ON val_c1y.linked_account_id = val.linked_account_id
-               AND val_c1y.sub_account_id = val.sub_account_id
-               AND val_c1y.history_entry_id = :change_1y_id
-         LEFT JOIN finbot_sub_accounts_valuation_history_entries val_c2y
-                ON val_c2y.linked_account_id = val.linked_account_id
-               AND val_c2y.sub_account_id = val.sub_account_id
-               AND val_c2y.history_entry_id = :change_2y_id
-             WHERE val.history_entry_id = :baseline_id
+    def get_valuation_changes(self, level: ValuationLevel, reference_ids):
+        """ Valuation change of all entries of the baseline history entry,
+        baseline and reference valuations are fetched at once
         """
-        rows = self.db_session.execute(query, reference_ids)
-        results = {}
-        for row in rows:
-            row = dict(row)
-            path = (row["linked_account_id"], row["sub_account_id"])
-            results[path] = ValuationChangeEntry(
-                **({k: v for k, v in row.items() if k.startswith("change_")}))
-        return results
+        baseline_id = reference_ids["baseline_id"]
+        history_entry_ids = {baseline_id} | set(get_reference_entry_ids(reference_ids))
+        valuations = self.get_valuations(level, history_entry_ids)
+        changes = compute_valuation_changes(
+            valuations.get(baseline_id, {}), valuations, reference_ids)
+        return {
+            key: ValuationChangeEntry(**change)
+            for key, change in changes.items()
+        }
+
+    def get_user_account_valuation_change(self, reference_ids):
+        results = self.get_valuation_changes(USER_ACCOUNT_LEVEL, reference_ids)
+        return results[()]
+
+    def get_linked_accounts_valuation_change(self, reference_ids):
+        results = self.get_valuation_changes(LINKED_ACCOUNTS_LEVEL, reference_ids)
+        return {
+            linked_account_id: change
+            for (linked_account_id, ), change in results.items()
+        }
+
+    def get_sub_accounts_valuation_change(self, reference_ids):
+        return self.get_valuation_changes(SUB_ACCOUNTS_LEVEL, reference_ids)
 
     def get_sub_accounts_items_valuation_change(self, reference_ids):
-        query = """
-            SELECT val.linked_account_id AS linked_account_id,
-                   val.sub_account_id AS sub_account_id,
-                   val.item_type AS item_type,
-                   val.name AS item_name,
-                   val.valuation - val_c1h.valuation AS change_1hour,
-                   val.valuation - val_c1d.valuation AS change_1day,
-                   val.valuation - val_c1w.valuation AS change_1week,
-                   val.valuation - val_c1m.valuation AS change_1month,
-                   val.valuation - val_c6m.valuation AS change_6months,
-                   val.valuation - val_c1y.valuation AS change_1year,
-                   val.valuation - val_c2y.valuation AS change_2years
-              FROM finbot_sub_accounts_items_valuation_history_entries val
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c1h
-                ON val_c1h.linked_account_id = val.linked_account_id
-               AND val_c1h.sub_account_id = val.sub_account_id
-               AND val_c1h.item_type = val.item_type
-               AND val_c1h.name = val.name
-               AND val_c1h.history_entry_id = :change_1h_id
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c1d
-                ON val_c1d.linked_account_id = val.linked_account_id
-               AND val_c1d.sub_account_id = val.sub_account_id
-               AND val_c1d.item_type = val.item_type
-               AND val_c1d.name = val.name
-               AND val_c1d.history_entry_id = :change_1d_id
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c1w
-                ON val_c1w.linked_account_id = val.linked_account_id
-               AND val_c1w.sub_account_id = val.sub_account_id
-               AND val_c1w.item_type = val.item_type
-               AND val_c1w.name = val.name
-               AND val_c1w.history_entry_id = :change_1w_id
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c1m
-                ON val_c1m.linked_account_id = val.linked_account_id
-               AND val_c1m.sub_account_id = val.sub_account_id
-               AND val_c1m.item_type = val.item_type
-               AND val_c1m.name = val.name
-               AND val_c1m.history_entry_id = :change_1m_id
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c6m
-                ON val_c6m.linked_account_id = val.linked_account_id
-               AND val_c6m.sub_account_id = val.sub_account_id
-               AND val_c6m.item_type = val.item_type
-               AND val_c6m.name = val.name
-               AND val_c6m.history_entry_id = :change_6m_id
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c1y
-                ON val_c1y.linked_account_id = val.linked_account_id
-               AND val_c1y.sub_account_id = val.sub_account_id
-               AND val_c1y.item_type = val.item_type
-               AND val_c1y.name = val.name
-               AND val_c1y.history_entry_id = :change_1y_id
-         LEFT JOIN finbot_sub_accounts_items_valuation_history_entries val_c2y
-                ON val_c2y.linked_account_id = val.linked_account_id
-               AND val_c2y.sub_account_id = val.sub_account_id
-               AND val_c2y.item_type = val.item_type
-               AND val_c2y.name = val.name
-               AND val_c2y.history_entry_id = :change_1y_id
-             WHERE val.history_entry_id = :baseline_id
-        """
-        rows = self.db_session.execute(query, reference_ids)
-        results = {}
-        for row in rows:
-            row = dict(row)
-            path = (
-                row["linked_account_id"], row["sub_account_id"], 
-                row["item_type"], row["item_name"]
-            )
-            results[path] = ValuationChangeEntry(
-                **({k: v for k, v in row.items() if k.startswith("change_")}))
-        return results
+        return self.get_valuation_changes(SUB_ACCOUNTS_ITEMS_LEVEL, reference_ids)
@@ -0,0 +1,82 @@
+import pandas as pd
+
+
+# grouping columns are categorical (see
+# ReportRepository.get_consistent_snapshot_data), only observed combinations
+# are aggregated
+LINKED_ACCOUNTS_GROUPS = ["linked_account_id", "snapshot_id"]
+
+SUB_ACCOUNTS_GROUPS = [
+    "linked_account_id",
+    "sub_account_id",
+    "sub_account_ccy",
+    "sub_account_description"
+]
+
+# items valuation history column -> consistent snapshot data column
+ITEMS_COLUMNS = {
+    "linked_account_id": "linked_account_id",
+    "sub_account_id": "sub_account_id",
+    "item_type": "item_type",
+    "name": "item_name",
+    "item_subtype": "item_subtype",
+    "units": "item_units",
+    "valuation": "value_snapshot_ccy",
+    "valuation_sub_account_ccy": "value_sub_account_ccy"
+}
+
+
+def get_user_account_valuation(data: pd.DataFrame):
+    return float(data["value_snapshot_ccy"].sum())
+
+
+def get_user_account_liabilities(data: pd.DataFrame):
+    return float(data.loc[data["value_snapshot_ccy"] < 0, "value_snapshot_ccy"].sum())
+
+
+def get_linked_accounts_valuation_frame(data: pd.DataFrame):
+    """ Linked accounts valuation history rows (one column per
+    finbot_linked_accounts_valuation_history_entries column)
+    """
+    return (data.groupby(LINKED_ACCOUNTS_GROUPS, observed=True)["value_snapshot_ccy"]
+                .sum()
+                .reset_index()
+                .rename(columns={
+                    "snapshot_id": "effective_snapshot_id",
+                    "value_snapshot_ccy": "valuation"
+                }))
+
+
+def get_sub_accounts_valuation_frame(data: pd.DataFrame):
+    """ Sub accounts valuation history rows (one column per
+    finbot_sub_accounts_valuation_history_entries column)
+    """
+    return (data.groupby(SUB_ACCOUNTS_GROUPS, observed=True)
+                .agg({
+                    "value_sub_account_ccy": "sum",
+                    "value_snapshot_ccy": "sum"
+                })
+                .reset_index()
+                .rename(columns={
+                    "value_snapshot_ccy": "valuation",
+                    "value_sub_account_ccy": "valuation_sub_account_ccy"
+                }))
+
+
+def get_sub_accounts_items_valuation_frame(data: pd.DataFrame):
+    """ Sub accounts items valuation history rows (one column per
+    finbot_sub_accounts_items_valuation_history_entries column)
+    """
+    return (data[list(ITEMS_COLUMNS.values())]
+                .rename(columns={
+                    data_column: column
+                    for column, data_column in ITEMS_COLUMNS.items()
+                }))
+
+
+def get_frame_valuations(frame: pd.DataFrame, key_columns):
+    """ Valuation (key -> valuation) of each row of a valuation history
+    frame, keys are made of 'key_columns' values
+    """
+    keys = zip(*[frame[column] for column in key_columns])
+    return dict(zip(keys, frame["valuation"]))
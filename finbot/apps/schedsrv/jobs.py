@@ -0,0 +1,255 @@
+from finbot.apps.schedsrv.scheduler import SchedulerSettings
+from finbot.core import utils
+from finbot.model import (
+    UserAccount,
+    WorkflowJob,
+    WorkflowJobKind,
+    WorkflowJobState
+)
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading
+import traceback
+import logging
+import random
+import socket
+import uuid
+import os
+
+
+class ClaimedJob(object):
+    def __init__(self, job_id, user_account_id, attempts):
+        self.id = job_id
+        self.user_account_id = user_account_id
+        self.attempts = attempts
+
+
+ACTIVE_STATES = [WorkflowJobState.Pending, WorkflowJobState.Running]
+FINISHED_STATES = [WorkflowJobState.Done, WorkflowJobState.Failed]
+
+
+class JobQueue(object):
+    """ Workflow jobs persisted in finbotdb. Jobs are claimed with
+    'SELECT ... FOR UPDATE SKIP LOCKED' so that any number of schedsrv
+    replicas can share the same table without running a job twice. A
+    claimed job is leased for a limited time: if the worker dies, the lease
+    expires and the job becomes claimable again.
+    """
+    def __init__(self, db_session, lease_duration=timedelta(minutes=15), max_attempts=3):
+        self.db_session = db_session
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+
+    def enqueue_due(self, kind: WorkflowJobKind, period: timedelta, jitter: timedelta):
+        """ Create a pending job for every user account that has neither an
+        active job, nor a job finished during the last period
+        """
+        session = self.db_session
+        now = utils.now_utc()
+        active = (session.query(WorkflowJob.user_account_id)
+                         .filter(WorkflowJob.kind == kind)
+                         .filter(WorkflowJob.state.in_(ACTIVE_STATES)))
+        recent = (session.query(WorkflowJob.user_account_id)
+                         .filter(WorkflowJob.kind == kind)
+                         .filter(WorkflowJob.state.in_(FINISHED_STATES))
+                         .filter(WorkflowJob.finished_at > now - period))
+        due_user_account_ids = [
+            user_account_id for (user_account_id,) in
+            (session.query(UserAccount.id)
+                    .filter(~UserAccount.id.in_(active))
+                    .filter(~UserAccount.id.in_(recent))
+                    .all())
+        ]
+        if not due_user_account_ids:
+            session.commit()
+            return 0
+        statement = (insert(WorkflowJob.__table__)
+                     .values([
+                         {
+                             "user_account_id": user_account_id,
+                             "kind": kind,
+                             "state": WorkflowJobState.Pending,
+                             "scheduled_at": now + timedelta(
+                                 seconds=random.uniform(0, jitter.total_seconds())),
+                             "attempts": 0
+                         }
+                         for user_account_id in due_user_account_ids
+                     ])
+                     .on_conflict_do_nothing(
+                         index_elements=["user_account_id", "kind"],
+                         index_where=WorkflowJob.state.in_(ACTIVE_STATES)))
+        session.execute(statement)
+        session.commit()
+        return len(due_user_account_ids)
+
+    def claim(self, kind: WorkflowJobKind, worker_id):
+        """ Lease the next pending (or abandoned) job, return None when there
+        is nothing to do
+        """
+        session = self.db_session
+        while True:
+            now = utils.now_utc()
+            job = (session.query(WorkflowJob)
+                          .filter(WorkflowJob.kind == kind)
+                          .filter(or_(
+                              and_(WorkflowJob.state == WorkflowJobState.Pending,
+                                   WorkflowJob.scheduled_at <= now),
+                              and_(WorkflowJob.state == WorkflowJobState.Running,
+                                   WorkflowJob.lease_until < now)))
+                          .order_by(WorkflowJob.scheduled_at)
+                          .with_for_update(skip_locked=True)
+                          .first())
+            if job is None:
+                session.commit()
+                return None
+            if job.state == WorkflowJobState.Running:
+                logging.warning(f"lease expired for job_id={job.id} "
+                                f"(leased by {job.leased_by}, attempt {job.attempts})")
+                if job.attempts >= self.max_attempts:
+                    job.state = WorkflowJobState.Failed
+                    job.last_error = f"lease expired after {job.attempts} attempt(s)"
+                    job.finished_at = now
+                    session.commit()
+                    continue
+            job.state = WorkflowJobState.Running
+            job.leased_by = worker_id
+            job.lease_until = now + self.lease_duration
+            job.attempts += 1
+            claimed = ClaimedJob(job.id, job.user_account_id, job.attempts)
+            session.commit()
+            return claimed
+
+    def _update_leased(self, job_id, worker_id, values):
+        count = (self.db_session.query(WorkflowJob)
+                                .filter(WorkflowJob.id == job_id)
+                                .filter(WorkflowJob.leased_by == worker_id)
+                                .filter(WorkflowJob.state == WorkflowJobState.Running)
+                                .update(values, synchronize_session=False))
+        self.db_session.commit()
+        if not count:
+            logging.warning(f"job_id={job_id} is no longer leased by {worker_id}")
+        return bool(count)
+
+    def renew(self, job_id, worker_id):
+        return self._update_leased(job_id, worker_id, {
+            WorkflowJob.lease_until: utils.now_utc() + self.lease_duration
+        })
+
+    def complete(self, job_id, worker_id):
+        return self._update_leased(job_id, worker_id, {
+            WorkflowJob.state: WorkflowJobState.Done,
+            WorkflowJob.lease_until: None,
+            WorkflowJob.finished_at: utils.now_utc()
+        })
+
+    def fail(self, job_id, worker_id, attempts, error, retry_delay: timedelta):
+        now = utils.now_utc()
+        if attempts >= self.max_attempts:
+            return self._update_leased(job_id, worker_id, {
+                WorkflowJob.state: WorkflowJobState.Failed,
+                WorkflowJob.lease_until: None,
+                WorkflowJob.last_error: error,
+                WorkflowJob.finished_at: now
+            })
+        return self._update_leased(job_id, worker_id, {
+            WorkflowJob.state: WorkflowJobState.Pending,
+            WorkflowJob.lease_until: None,
+            WorkflowJob.last_error: error,
+            WorkflowJob.scheduled_at: now + retry_delay
+        })
+
+
+def make_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class JobWorkers(object):
+    """ Fill the job table from user accounts on a cadence and run claimed
+    jobs with a bounded pool of workers. Every schedsrv replica can run its
+    own JobWorkers against the same database.
+    """
+    def __init__(self, db_session, workflow, settings: SchedulerSettings,
+                 lease_duration=timedelta(minutes=15), max_attempts=3,
+                 poll_interval=timedelta(seconds=10)):
+        self.db_session = db_session
+        self.queue = JobQueue(db_session, lease_duration, max_attempts)
+        self.workflow = workflow
+        self.settings = settings
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _keep_leased(self, job_id, worker_id, done: threading.Event):
+        renew_interval = self.queue.lease_duration.total_seconds() / 3
+        try:
+            while not done.wait(renew_interval):
+                if not self.queue.renew(job_id, worker_id):
+                    return
+        except Exception as e:
+            logging.warning(f"failed to renew lease for job_id={job_id}: {e}")
+        finally:
+            self.db_session.remove()
+
+    def _run_job(self, job_id, user_account_id, attempts, worker_id):
+        logging.info(f"running job_id={job_id} for user_id={user_account_id} (attempt {attempts})")
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._keep_leased, args=(job_id, worker_id, done), daemon=True)
+        heartbeat.start()
+        try:
+            self.workflow(user_account_id)
+            error = None
+        except Exception as e:
+            logging.warning(f"failure while running workflow for "
+                            f"user_id={user_account_id}: {e}, trace: \n{traceback.format_exc()}")
+            error = str(e)
+        finally:
+            done.set()
+            heartbeat.join()
+        if error is None:
+            self.queue.complete(job_id, worker_id)
+        else:
+            self.queue.fail(job_id, worker_id, attempts, error, self.settings.retry_delay)
+
+    def _work(self):
+        worker_id = make_worker_id()
+        logging.info(f"job worker {worker_id} started")
+        while not self._stopped.is_set():
+            try:
+                job = self.queue.claim(WorkflowJobKind.Snapshot, worker_id)
+                self.db_session.remove()
+                if job is None:
+                    self._stopped.wait(self.poll_interval.total_seconds())
+                    continue
+                self._run_job(job.id, job.user_account_id, job.attempts, worker_id)
+            except Exception as e:
+                logging.warning(f"job worker {worker_id} error: {e}, trace: \n{traceback.format_exc()}")
+                self._stopped.wait(self.poll_interval.total_seconds())
+            finally:
+                self.db_session.remove()
+
+    def _fill(self):
+        while not self._stopped.is_set():
+            try:
+                count = self.queue.enqueue_due(
+                    WorkflowJobKind.Snapshot, self.settings.period, self.settings.jitter)
+                logging.info(f"enqueued {count} new job(s)")
+            except Exception as e:
+                logging.warning(f"failed to enqueue jobs: {e}, trace: \n{traceback.format_exc()}")
+            finally:
+                self.db_session.remove()
+            self._stopped.wait(self.settings.refresh_period.total_seconds())
+
+    def run(self):
+        settings = self.settings
+        logging.info(f"starting job workers with {settings.workers} worker(s), "
+                     f"period={settings.period}")
+        with ThreadPoolExecutor(max_workers=settings.workers + 1,
+                                thread_name_prefix="job") as executor:
+            executor.submit(self._fill)
+            for _ in range(settings.workers):
+                executor.submit(self._work)
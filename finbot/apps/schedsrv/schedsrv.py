@@ -1,11 +1,12 @@
 from finbot.clients.snap import SnapClient
 from finbot.clients.history import HistoryClient
+from finbot.apps.schedsrv.scheduler import Scheduler, SchedulerSettings
+from finbot.apps.schedsrv.jobs import JobWorkers
 from finbot.core import dbutils
 from finbot.model import UserAccount
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
-import time
-import traceback
+from datetime import timedelta
 import logging.config
 import logging
 import os
@@ -28,15 +29,18 @@ logging.config.dictConfig({
 })
 
 
-def run_workflow(user_account_id, snap_client, hist_client):
+def run_workflow(user_account_id, snap_client, hist_client, snapshot_timeout):
     logging.info(f"starting workflow for user_id={user_account_id}")
     
     logging.info(f"will take raw snapshot")
 
-    snapshot_metadata = snap_client.take_snapshot(user_account_id)
+    snapshot_metadata = snap_client.take_snapshot_async(user_account_id)
     logging.debug(snapshot_metadata)
 
     snapshot_id = snapshot_metadata["snapshot"]["identifier"]
+    logging.info(f"raw snapshot requested with id={snapshot_id}, waiting for completion")
+
+    snapshot_metadata = snap_client.wait_snapshot(snapshot_id, timeout=snapshot_timeout)
     
     logging.info(f"raw snapshot created with id={snapshot_id}")
     logging.debug(snapshot_metadata)
@@ -52,6 +56,16 @@ def run_workflow(user_account_id, snap_client, hist_client):
     logging.info(f"workflow done for user_id={user_account_id}")
 
 
+def load_scheduler_settings():
+    workers = int(os.environ.get("FINBOT_SCHEDSRV_WORKERS", 4))
+    return SchedulerSettings(
+        workers=workers,
+        max_in_flight=int(os.environ.get("FINBOT_SCHEDSRV_MAX_IN_FLIGHT", workers)),
+        period=timedelta(seconds=int(os.environ.get("FINBOT_SCHEDSRV_PERIOD", 6 * 3600))),
+        jitter=timedelta(seconds=int(os.environ.get("FINBOT_SCHEDSRV_JITTER", 600))),
+        retry_delay=timedelta(seconds=int(os.environ.get("FINBOT_SCHEDSRV_RETRY_DELAY", 1800))))
+
+
 def main():
     db_engine = create_engine(os.environ['FINBOT_DB_URL'])
     db_session = dbutils.add_persist_utilities(scoped_session(sessionmaker(bind=db_engine)))
@@ -64,18 +78,45 @@ def main():
     hist_client = HistoryClient(histwsrv_endpoint)
     logging.info(f"history report client created with {histwsrv_endpoint} endpoint")
 
-    while True:
-        for user_account in db_session.query(UserAccount).all():
-            try:
-                run_workflow(
-                    user_account_id=user_account.id,
-                    snap_client=snap_client, 
-                    hist_client=hist_client)
-            except Exception as e:
-                logging.warning(f"failure while running workflow for "
-                                f"user_id={user_account.id}: {e}, trace: \n{traceback.format_exc()}")
-        time.sleep(6 * 3600)
+    def get_user_account_ids():
+        try:
+            return [user_account.id for user_account in db_session.query(UserAccount).all()]
+        finally:
+            db_session.remove()
+
+    # bounds the wait for a background snapshot, which may never finish if
+    # snapwsrv restarted while taking it
+    snapshot_timeout = timedelta(seconds=int(os.environ.get("FINBOT_SCHEDSRV_SNAPSHOT_TIMEOUT", 3600)))
+
+    def workflow(user_account_id):
+        run_workflow(
+            user_account_id=user_account_id,
+            snap_client=snap_client,
+            hist_client=hist_client,
+            snapshot_timeout=snapshot_timeout)
+
+    settings = load_scheduler_settings()
+    mode = os.environ.get("FINBOT_SCHEDSRV_MODE", "local")
+    logging.info(f"scheduler mode is '{mode}'")
+
+    if mode == "queue":
+        # jobs are persisted in finbotdb and can be shared by several replicas
+        scheduler = JobWorkers(
+            db_session=db_session,
+            workflow=workflow,
+            settings=settings,
+            lease_duration=timedelta(seconds=int(os.environ.get("FINBOT_SCHEDSRV_LEASE", 900))),
+            max_attempts=int(os.environ.get("FINBOT_SCHEDSRV_MAX_ATTEMPTS", 3)))
+    elif mode == "local":
+        scheduler = Scheduler(
+            workflow=workflow,
+            user_accounts_getter=get_user_account_ids,
+            settings=settings)
+    else:
+        raise ValueError(f"unknown scheduler mode: '{mode}'")
+
+    scheduler.run()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
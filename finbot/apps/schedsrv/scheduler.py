@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading
+import traceback
+import logging
+import random
+import heapq
+import time
+
+
+class SchedulerSettings(object):
+    def __init__(self, workers=4, max_in_flight=None, period=timedelta(hours=6),
+                 jitter=timedelta(minutes=10), retry_delay=timedelta(minutes=30),
+                 refresh_period=timedelta(minutes=5)):
+        self.workers = workers
+        self.max_in_flight = min(max_in_flight or workers, workers)
+        self.period = period
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.refresh_period = refresh_period
+
+
+class Scheduler(object):
+    """ Run a workflow for every user account on a fixed period, using a
+    bounded pool of workers. Next run times are kept in a priority queue
+    (earliest first) and start times are jittered so that runs for many
+    users do not all hit the snapshot service at the same instant.
+    """
+    def __init__(self, workflow, user_accounts_getter, settings: SchedulerSettings):
+        self.workflow = workflow
+        self.user_accounts_getter = user_accounts_getter
+        self.settings = settings
+        self._queue = []  # (next_run_time, user_account_id, generation)
+        # only the latest queue entry of each user account is valid (older
+        # ones are left in the queue when a user account is scheduled again)
+        self._generations = {}  # user_account_id -> generation
+        self._in_flight = set()
+        self._known = set()
+        self._wakeup = threading.Condition()
+        self._stopped = False
+
+    def _jitter(self):
+        return random.uniform(0, self.settings.jitter.total_seconds())
+
+    def _push(self, user_account_id, run_time):
+        generation = self._generations.get(user_account_id, 0) + 1
+        self._generations[user_account_id] = generation
+        heapq.heappush(self._queue, (run_time, user_account_id, generation))
+
+    def refresh_user_accounts(self):
+        user_account_ids = set(self.user_accounts_getter())
+        with self._wakeup:
+            now = time.time()
+            for user_account_id in user_account_ids - self._known - self._in_flight:
+                logging.info(f"scheduling new user_id={user_account_id}")
+                self._push(user_account_id, now + self._jitter())
+            self._known = user_account_ids
+            self._wakeup.notify()
+
+    def _run_workflow(self, user_account_id):
+        try:
+            self.workflow(user_account_id)
+            return True
+        except Exception as e:
+            logging.warning(f"failure while running workflow for "
+                            f"user_id={user_account_id}: {e}, trace: \n{traceback.format_exc()}")
+            return False
+
+    def _on_done(self, user_account_id, started_at, future):
+        success = future.result()
+        delay = self.settings.period if success else self.settings.retry_delay
+        with self._wakeup:
+            self._in_flight.discard(user_account_id)
+            if user_account_id in self._known:
+                self._push(user_account_id, started_at + delay.total_seconds() + self._jitter())
+            self._wakeup.notify()
+
+    def _pop_due(self, now):
+        due = []
+        while (self._queue
+               and self._queue[0][0] <= now
+               and len(self._in_flight) + len(due) < self.settings.max_in_flight):
+            _, user_account_id, generation = heapq.heappop(self._queue)
+            if user_account_id not in self._known:
+                continue
+            if generation != self._generations.get(user_account_id):
+                continue
+            due.append(user_account_id)
+        return due
+
+    def _next_wakeup(self, now):
+        if self._queue and len(self._in_flight) < self.settings.max_in_flight:
+            return max(0.0, self._queue[0][0] - now)
+        return None
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def run(self):
+        settings = self.settings
+        logging.info(f"starting scheduler with {settings.workers} worker(s), "
+                     f"max_in_flight={settings.max_in_flight}, period={settings.period}")
+        last_refresh = None
+        with ThreadPoolExecutor(max_workers=settings.workers,
+                                thread_name_prefix="workflow") as executor:
+            while True:
+                now = time.time()
+                if last_refresh is None or now - last_refresh >= settings.refresh_period.total_seconds():
+                    try:
+                        self.refresh_user_accounts()
+                    except Exception as e:
+                        logging.warning(f"failed to refresh user accounts: {e}")
+                    last_refresh = now
+                with self._wakeup:
+                    if self._stopped:
+                        break
+                    for user_account_id in self._pop_due(now):
+                        self._in_flight.add(user_account_id)
+                        future = executor.submit(self._run_workflow, user_account_id)
+                        future.add_done_callback(
+                            lambda f, uid=user_account_id, t=now: self._on_done(uid, t, f))
+                    timeout = self._next_wakeup(now)
+                    refresh_timeout = settings.refresh_period.total_seconds() - (time.time() - last_refresh)
+                    timeout = max(0.0, min(refresh_timeout, timeout if timeout is not None else refresh_timeout))
+                    self._wakeup.wait(timeout)
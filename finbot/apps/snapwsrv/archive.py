@@ -0,0 +1,72 @@
+from finbot.model import RawSnapshotArchiveEntry
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec(object):
+    Gzip = "gzip"
+    Zstd = "zstd"
+
+
+def get_default_codec():
+    return Codec.Zstd if zstandard else Codec.Gzip
+
+
+def compress(data: bytes, codec):
+    if codec == Codec.Gzip:
+        return gzip.compress(data)
+    if codec == Codec.Zstd:
+        if zstandard is None:
+            raise RuntimeError("zstd codec requires the 'zstandard' package")
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"unknown archive codec '{codec}'")
+
+
+def decompress(payload: bytes, codec):
+    if codec == Codec.Gzip:
+        return gzip.decompress(payload)
+    if codec == Codec.Zstd:
+        if zstandard is None:
+            raise RuntimeError("zstd codec requires the 'zstandard' package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"unknown archive codec '{codec}'")
+
+
+def make_archive_entry(snapshot_id, raw_account, codec=None) -> RawSnapshotArchiveEntry:
+    """ Archive entry for a linked account raw snapshot (as yielded by
+    snapwsrv.iter_raw_snapshot)
+    """
+    codec = codec or get_default_codec()
+    data = json.dumps(raw_account["data"], separators=(",", ":")).encode()
+    return RawSnapshotArchiveEntry(
+        snapshot_id=snapshot_id,
+        linked_account_id=raw_account["account_id"],
+        provider_id=raw_account["provider"],
+        codec=codec,
+        raw_size=len(data),
+        payload=compress(data, codec))
+
+
+def iter_archived_raw_snapshot(db_session, snapshot_id):
+    """ Yield linked accounts raw snapshots archived for this snapshot, in
+    the same format as snapwsrv.iter_raw_snapshot. Payloads are only
+    decompressed when consumed.
+    """
+    entries = (db_session.query(RawSnapshotArchiveEntry.linked_account_id,
+                                RawSnapshotArchiveEntry.provider_id,
+                                RawSnapshotArchiveEntry.codec,
+                                RawSnapshotArchiveEntry.payload)
+                         .filter(RawSnapshotArchiveEntry.snapshot_id == snapshot_id)
+                         .order_by(RawSnapshotArchiveEntry.linked_account_id)
+                         .all())
+    for linked_account_id, provider_id, codec, payload in entries:
+        yield {
+            "provider": provider_id,
+            "account_id": linked_account_id,
+            "data": json.loads(decompress(payload, codec))
+        }
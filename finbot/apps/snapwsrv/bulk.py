@@ -0,0 +1,74 @@
+from finbot.model import (
+    LinkedAccountSnapshotEntry,
+    SubAccountSnapshotEntry,
+    SubAccountItemSnapshotEntry
+)
+import logging
+
+
+class SubAccountRows(object):
+    def __init__(self, row):
+        self.row = row
+        self.items = []
+
+
+class LinkedAccountRows(object):
+    """ Plain rows for a linked account snapshot entry and its sub accounts /
+    items, written by 'write_linked_account_rows'
+    """
+    def __init__(self, row):
+        self.row = row
+        self.sub_accounts = {}  # sub_account_id -> SubAccountRows
+
+    @property
+    def items_count(self):
+        return sum(len(sub_account.items) for sub_account in self.sub_accounts.values())
+
+
+def _insert_returning_ids(db_session, table, rows, key_column):
+    """ Multi-row insert, return generated ids mapped by 'key_column' value
+    """
+    if not rows:
+        return {}
+    results = db_session.execute(
+        table.insert()
+             .values(rows)
+             .returning(table.c.id, table.c[key_column]))
+    return {key: row_id for row_id, key in results}
+
+
+def write_linked_account_rows(db_session, linked_account: LinkedAccountRows,
+                              chunk_size=5000):
+    """ Write a linked account snapshot entry with one statement per table
+    (plus one per 'chunk_size' items) rather than through the ORM unit of
+    work. Does not commit.
+    """
+    linked_account_table = LinkedAccountSnapshotEntry.__table__
+    sub_account_table = SubAccountSnapshotEntry.__table__
+    item_table = SubAccountItemSnapshotEntry.__table__
+
+    linked_account_entry_id = db_session.execute(
+        linked_account_table.insert()
+                            .values(linked_account.row)
+                            .returning(linked_account_table.c.id)).scalar()
+
+    sub_account_ids = _insert_returning_ids(
+        db_session,
+        sub_account_table,
+        [
+            dict(sub_account.row, linked_account_snapshot_entry_id=linked_account_entry_id)
+            for sub_account in linked_account.sub_accounts.values()
+        ],
+        key_column="sub_account_id")
+
+    item_rows = [
+        dict(item, sub_account_snapshot_entry_id=sub_account_ids[sub_account_id])
+        for sub_account_id, sub_account in linked_account.sub_accounts.items()
+        for item in sub_account.items
+    ]
+    for offset in range(0, len(item_rows), chunk_size):
+        db_session.execute(item_table.insert(), item_rows[offset:offset + chunk_size])
+
+    logging.info(f"bulk inserted linked account entry {linked_account_entry_id} with "
+                 f"{len(sub_account_ids)} sub account(s) and {len(item_rows)} item(s)")
+    return linked_account_entry_id
@@ -0,0 +1,100 @@
+from finbot import providers
+from finbot.providers.factory import get_provider
+from contextlib import contextmanager
+import threading
+import logging
+import json
+
+
+DEFAULT_LIMITS = {
+    "selenium": 4,
+    "api": 16,
+    "providers": {
+        "vanguard_uk": 2,
+        "kraken_us": 10
+    }
+}
+
+
+class ProviderKind(object):
+    Selenium = "selenium"
+    Api = "api"
+
+
+def get_selenium_providers():
+    return {
+        provider_id
+        for provider_id, provider in get_provider.providers.items()
+        if issubclass(provider.api_module.Api, providers.SeleniumBased)
+    }
+
+
+class ConcurrencyGovernor(object):
+    """ Process-wide limit on the number of concurrent financial data requests
+    sent to finbotwsrv. Each provider has its own limit (optional) and all
+    Selenium (resp. API) based providers share a global limit. Requests over
+    the limit wait for a free slot rather than fail.
+    """
+    def __init__(self, selenium_limit, api_limit, provider_limits=None,
+                 selenium_providers=None):
+        self.selenium_providers = set(selenium_providers or get_selenium_providers())
+        self._kinds = {
+            ProviderKind.Selenium: threading.BoundedSemaphore(selenium_limit),
+            ProviderKind.Api: threading.BoundedSemaphore(api_limit)
+        }
+        self._providers = {
+            provider_id: threading.BoundedSemaphore(limit)
+            for provider_id, limit in (provider_limits or {}).items()
+        }
+
+    @staticmethod
+    def from_settings(settings):
+        return ConcurrencyGovernor(
+            selenium_limit=settings["selenium"],
+            api_limit=settings["api"],
+            provider_limits=settings.get("providers"),
+            selenium_providers=settings.get("selenium_providers"))
+
+    @staticmethod
+    def from_json(data):
+        """ Build a governor from a JSON encoded document overriding the
+        default limits, e.g: '{"selenium": 2, "providers": {"vanguard_uk": 1}}'
+        (provider limits are merged with the default ones)
+        """
+        settings = dict(DEFAULT_LIMITS)
+        settings["providers"] = dict(DEFAULT_LIMITS["providers"])
+        if data:
+            overrides = json.loads(data)
+            settings["providers"].update(overrides.pop("providers", None) or {})
+            settings.update(overrides)
+        return ConcurrencyGovernor.from_settings(settings)
+
+    def get_kind(self, provider_id):
+        if provider_id in self.selenium_providers:
+            return ProviderKind.Selenium
+        return ProviderKind.Api
+
+    @staticmethod
+    def _acquire(semaphore, description):
+        if not semaphore.acquire(blocking=False):
+            logging.info(f"concurrency limit reached for {description}, waiting")
+            semaphore.acquire()
+
+    @contextmanager
+    def acquire(self, provider_id):
+        # always acquire provider slot first, then kind slot: a request waiting
+        # for its provider slot does not hold a (shared) kind slot
+        kind = self.get_kind(provider_id)
+        provider_semaphore = self._providers.get(provider_id)
+        kind_semaphore = self._kinds[kind]
+        if provider_semaphore:
+            self._acquire(provider_semaphore, f"provider '{provider_id}'")
+        try:
+            self._acquire(kind_semaphore, f"{kind} providers")
+            try:
+                yield
+            finally:
+                kind_semaphore.release()
+        finally:
+            if provider_semaphore:
+                provider_semaphore.release()
@@ -1,25 +1,41 @@
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from flask import Flask, jsonify
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, jsonify, request
+from sqlalchemy import create_engine, func
 from sqlalchemy.orm import scoped_session, sessionmaker, joinedload
-from copy import deepcopy
+from datetime import timedelta
 from finbot.clients.finbot import FinbotClient, LineItem
 from finbot.core import crypto, utils, dbutils, fx
-from finbot.apps.support import request_handler, make_error
+from finbot.core.fx import Xccy
+from finbot.core.fx_store import FxRateStore
+from finbot.apps.snapwsrv.governor import ConcurrencyGovernor
+from finbot.apps.snapwsrv.bulk import write_linked_account_rows
+from finbot.apps.snapwsrv import archive
+from finbot.apps.snapwsrv.tree import (
+    compile_snapshot_tree,
+    compute_content_hash,
+    SnapshotResultsCount,
+    SnapshotBuilderVisitor,
+    SnapshotRowsCollector
+)
+from finbot.apps.support import (
+    request_handler,
+    make_error,
+    time_elapsed,
+    enable_compression,
+    ApplicationError
+)
 from finbot.model import (
     UserAccount,
     UserAccountSnapshot,
-    SnapshotStatus,
     LinkedAccountSnapshotEntry,
-    SubAccountSnapshotEntry,
-    SubAccountItemSnapshotEntry,
-    SubAccountItemType,
+    SnapshotStatus,
     XccyRateSnapshotEntry
 )
+import threading
 import traceback
 import logging.config
 import logging
+import time
 import os
 import json
 
@@ -49,8 +65,13 @@ def load_secret(path):
 secret = load_secret(os.environ["FINBOT_SECRET_PATH"])
 db_engine = create_engine(os.environ['FINBOT_DB_URL'])
 db_session = dbutils.add_persist_utilities(scoped_session(sessionmaker(bind=db_engine)))
+fx_rates = FxRateStore(
+    db_session,
+    source=fx.create_source(os.environ.get("FINBOT_FX_SOURCE")),
+    spot_ttl=timedelta(seconds=int(os.environ.get("FINBOT_SNAPWSRV_SPOT_FX_TTL", 60))))
 
 app = Flask(__name__)
+enable_compression(app)
 
 
 @app.teardown_appcontext
@@ -58,90 +79,27 @@ def cleanup_context(*args, **kwargs):
     db_session.remove()
 
 
-class SnapshotTreeVisitor(object):
-    def visit_account(self, account, errors):
-        pass
-
-    def visit_sub_account(self, account, sub_account, balance):
-        pass
-
-    def visit_item(self, account, sub_account, item_type, item):
-        pass
-
-
-@dataclass(frozen=True, eq=True)
-class Xccy(object):
-    domestic: str
-    foreign: str
-
-    def __str__(self):
-        return f"{self.domestic}{self.foreign}"
-
-
-def visit_snapshot_tree(raw_snapshot, visitor):
-    def balance_has_priority(data):
-        if data["line_item"] == "balances":
-            return 0
-        return 1
-
-    def iter_errors(account_data):
-        if "error" in account_data:
-            yield {
-                "scope": "linked_account",
-                "error": account_data["error"]
-            }
-            return
-        for data_entry in account_data["financial_data"]:
-            if "error" in data_entry:
-                yield {
-                    "scope": f"linked_account.{data_entry['line_item']}",
-                    "error": data_entry["error"]
-                }
-
-    for account in raw_snapshot:
-        real_account = {"id": account["account_id"], "provider": account["provider"]}
-        account_errors = list(iter_errors(account["data"]))
-        visitor.visit_account(real_account, account_errors)
-        if account_errors:
-            continue
-        for entry in sorted(account["data"]["financial_data"], key=balance_has_priority):
-            line_item = entry["line_item"]
-            for result in entry["results"]:
-                sub_account = deepcopy(result["account"])
-                if line_item == "balances":
-                    visitor.visit_sub_account(
-                        real_account,
-                        sub_account,
-                        result["balance"])
-                elif line_item == "assets":
-                    for asset in result["assets"]:
-                        visitor.visit_item(
-                            real_account,
-                            sub_account,
-                            SubAccountItemType.Asset,
-                            deepcopy(asset))
-                elif line_item == "liabilities":
-                    for liability in result["liabilities"]:
-                        visitor.visit_item(
-                            real_account,
-                            sub_account,
-                            SubAccountItemType.Liability,
-                            deepcopy(liability))
-
-
-class XccyCollector(SnapshotTreeVisitor):
-    def __init__(self, target_ccy):
-        self.target_ccy = target_ccy
-        self.xccys = set()
-
-    def visit_sub_account(self, account, sub_account, balance):
-        if sub_account["iso_currency"] != self.target_ccy:
-            self.xccys.add(Xccy(sub_account["iso_currency"], self.target_ccy))
-
-
-class CachedXccyRatesGetter(object):
-    def __init__(self, xccy_rates):
-        self.xccy_rates = xccy_rates
+class LazyXccyRatesGetter(object):
+    """ Cross currency rates fetched as new currencies show up in the
+    snapshot (see 'fetch_missing'). Spot rates are fetched unless a 'date'
+    is given (historical rates).
+    """
+    def __init__(self, fx_rates_store: FxRateStore, date=None, xccy_rates=None):
+        self.fx_rates_store = fx_rates_store
+        self.date = date
+        self.xccy_rates = dict(xccy_rates or {})
+
+    def fetch_missing(self, xccys):
+        """ Fetch rates for currency pairs not seen yet, return new rates
+        """
+        missing = set(xccys) - set(self.xccy_rates.keys())
+        if not missing:
+            return {}
+        logging.info("fetching cross currency rates for: "
+                     f"{', '.join(str(xccy) for xccy in missing)}")
+        new_rates = self.fx_rates_store.get_xccy_rates(missing, date=self.date)
+        self.xccy_rates.update(new_rates)
+        return new_rates
 
     def __call__(self, xccy: Xccy):
         if xccy.foreign == xccy.domestic:
@@ -149,70 +107,6 @@ class CachedXccyRatesGetter(object):
         return self.xccy_rates[xccy]
 
 
-class SnapshotResultsCount(object):
-    def __init__(self, total=0, failures=0):
-        self.total = total
-        self.failures = failures
-
-    @property
-    def success(self):
-        return self.total - self.failures
-
-
-class SnapshotBuilderVisitor(SnapshotTreeVisitor):
-    def __init__(self,
-                 snapshot: UserAccountSnapshot,
-                 xccy_rates_getter,
-                 target_ccy):
-        self.snapshot = snapshot
-        self.xccy_rates_getter = xccy_rates_getter
-        self.target_ccy = target_ccy
-        self.linked_accounts = {}  # linked_account_id -> account
-        self.sub_accounts = {}  # link_account_id, sub_account_id -> sub_account
-        self.results_count = SnapshotResultsCount()
-
-    def visit_account(self, account, errors):
-        snapshot = self.snapshot
-        account_id = account["id"]
-        assert account_id not in self.linked_accounts
-        linked_account_entry = LinkedAccountSnapshotEntry(
-            linked_account_id=account_id)
-        linked_account_entry.success = not bool(errors)
-        self.results_count.total += 1
-        if errors:
-            self.results_count.failures += 1
-            linked_account_entry.failure_details = errors
-        snapshot.linked_accounts_entries.append(linked_account_entry)
-        self.linked_accounts[account_id] = linked_account_entry
-
-    def visit_sub_account(self, account, sub_account, balance):
-        account_id = account["id"]
-        linked_account = self.linked_accounts[account_id]
-        sub_account_id = sub_account["id"]
-        assert sub_account_id not in self.sub_accounts
-        sub_account_entry = SubAccountSnapshotEntry(
-            sub_account_id=sub_account_id,
-            sub_account_ccy=sub_account["iso_currency"],
-            sub_account_description=sub_account["name"])
-        linked_account.sub_accounts_entries.append(sub_account_entry)
-        self.sub_accounts[(account_id, sub_account_id)] = sub_account_entry
-
-    def visit_item(self, account, sub_account, item_type, item):
-        linked_account_id = account["id"]
-        sub_account_id = sub_account["id"]
-        sub_account_entry = self.sub_accounts[(linked_account_id, sub_account_id)]
-        item_value = item["value"]
-        new_item = SubAccountItemSnapshotEntry(
-            item_type=item_type,
-            name=item["name"],
-            item_subtype=item["type"],
-            units=item.get("units"),
-            value_sub_account_ccy=item_value,
-            value_snapshot_ccy=item_value * self.xccy_rates_getter(
-                Xccy(sub_account["iso_currency"], self.target_ccy)))
-        sub_account_entry.items_entries.append(new_item)
-
-
 class AccountSnapshotRequest(object):
     def __init__(self, account_id, provider_id, credentials_data, line_items):
         self.account_id = account_id
@@ -221,20 +115,196 @@ class AccountSnapshotRequest(object):
         self.line_items = line_items
 
 
-def dispatch_snapshot_entry(request: AccountSnapshotRequest):
+class LinkedAccountStatus(object):
+    Pending = "pending"
+    Processing = "processing"
+    Success = "success"
+    Failure = "failure"
+
+
+class SnapshotProgressTracker(object):
+    """ Keeps track of in-progress snapshots (per linked account status) taken
+    by this process. Entries are dropped when the snapshot is finished, the
+    final status is then read from finbotdb.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots = {}  # snapshot_id -> linked_account_id -> status
+
+    def start(self, snapshot_id, requests):
+        with self._lock:
+            self._snapshots[snapshot_id] = {
+                request.account_id: {
+                    "linked_account_id": request.account_id,
+                    "provider_id": request.provider_id,
+                    "status": LinkedAccountStatus.Pending
+                }
+                for request in requests
+            }
+
+    def update(self, snapshot_id, linked_account_id, status):
+        with self._lock:
+            linked_accounts = self._snapshots.get(snapshot_id)
+            if linked_accounts and linked_account_id in linked_accounts:
+                linked_accounts[linked_account_id]["status"] = status
+
+    def finish(self, snapshot_id):
+        with self._lock:
+            self._snapshots.pop(snapshot_id, None)
+
+    def get_snapshot_ids(self):
+        with self._lock:
+            return list(self._snapshots.keys())
+
+    def get(self, snapshot_id):
+        with self._lock:
+            linked_accounts = self._snapshots.get(snapshot_id)
+            if linked_accounts is None:
+                return None
+            return [dict(entry) for entry in linked_accounts.values()]
+
+
+snapshot_progress = SnapshotProgressTracker()
+finbot_client = FinbotClient(os.environ["FINBOT_FINBOTWSRV_ENDPOINT"])
+concurrency_governor = ConcurrencyGovernor.from_json(
+    os.environ.get("FINBOT_SNAPWSRV_CONCURRENCY_LIMITS"))
+# linked accounts with at least this number of items are written with bulk
+# inserts rather than through the ORM
+bulk_write_threshold = int(os.environ.get("FINBOT_SNAPWSRV_BULK_WRITE_THRESHOLD", 500))
+# raw linked accounts snapshots are archived (compressed) unless disabled,
+# they can later be replayed (see 'replay_snapshot')
+archive_codec = (os.environ.get("FINBOT_SNAPWSRV_ARCHIVE_CODEC") or archive.get_default_codec()
+                 if bool(int(os.environ.get("FINBOT_SNAPWSRV_ARCHIVE_RAW_SNAPSHOTS", 1)))
+                 else None)
+background_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("FINBOT_SNAPWSRV_BACKGROUND_WORKERS", 4)),
+    thread_name_prefix="snapshot")
+# background snapshots only live in the process taking them, which refreshes
+# their heartbeat: a snapshot still processing without heartbeat for this long
+# was lost (e.g. snapwsrv restarted) and is failed
+snapshot_heartbeat_period = timedelta(seconds=int(os.environ.get("FINBOT_SNAPWSRV_HEARTBEAT_PERIOD", 30)))
+stale_snapshot_timeout = timedelta(seconds=int(os.environ.get("FINBOT_SNAPWSRV_STALE_SNAPSHOT_TIMEOUT", 300)))
+
+
+class SnapshotHeartbeat(object):
+    """ Periodically refresh the heartbeat of snapshots taken by this process
+    (started with the first snapshot)
+    """
+    def __init__(self, tracker: SnapshotProgressTracker, period: timedelta):
+        self.tracker = tracker
+        self.period = period
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="snapshot_heartbeat", daemon=True)
+                self._thread.start()
+
+    def _beat(self, snapshot_ids):
+        try:
+            (db_session.query(UserAccountSnapshot)
+                       .filter(UserAccountSnapshot.id.in_(snapshot_ids))
+                       .filter(UserAccountSnapshot.status == SnapshotStatus.Processing)
+                       .update({UserAccountSnapshot.heartbeat_at: utils.now_utc()},
+                               synchronize_session=False))
+            db_session.commit()
+        except Exception as e:
+            logging.warning(f"failed to refresh snapshots heartbeat: {e}")
+            db_session.rollback()
+        finally:
+            db_session.remove()
+
+    def _run(self):
+        while True:
+            time.sleep(self.period.total_seconds())
+            snapshot_ids = self.tracker.get_snapshot_ids()
+            if snapshot_ids:
+                self._beat(snapshot_ids)
+
+
+snapshot_heartbeat = SnapshotHeartbeat(snapshot_progress, snapshot_heartbeat_period)
+
+
+def fail_stale_snapshots(snapshot_id=None):
+    """ Mark as failed processing snapshots whose heartbeat was not refreshed
+    for longer than 'stale_snapshot_timeout' (by any snapwsrv process)
+    """
+    last_heartbeat = func.coalesce(UserAccountSnapshot.heartbeat_at, UserAccountSnapshot.start_time)
+    query = (db_session.query(UserAccountSnapshot)
+                       .filter(UserAccountSnapshot.status == SnapshotStatus.Processing)
+                       .filter(last_heartbeat < utils.now_utc() - stale_snapshot_timeout))
+    if snapshot_id is not None:
+        query = query.filter(UserAccountSnapshot.id == snapshot_id)
+    failed_count = query.update({UserAccountSnapshot.status: SnapshotStatus.Failure,
+                                 UserAccountSnapshot.end_time: utils.now_utc()},
+                                synchronize_session=False)
+    db_session.commit()
+    if failed_count:
+        logging.warning(f"marked {failed_count} stale processing snapshot(s) as failed")
+    return failed_count
+
+
+@app.cli.command("fail-stale-snapshots")
+def fail_stale_snapshots_command():
+    """ Mark stale processing snapshots as failed (run at startup)
+    """
+    try:
+        fail_stale_snapshots()
+    finally:
+        db_session.remove()
+
+
+def prefetch_xccy_rates(balances_results, requested_ccy):
+    """ Warm up spot rates for the currencies of freshly received sub
+    accounts, while remaining line items are still being retrieved
+    """
+    xccys = set(
+        Xccy(result["account"]["iso_currency"], requested_ccy)
+        for result in balances_results
+        if result["account"]["iso_currency"] != requested_ccy
+    )
+    if not xccys:
+        return
+    try:
+        fx_rates.get_spot_rates(xccys)
+    except Exception as e:
+        logging.warning(f"failed to prefetch cross currency rates: {e}")
+
+
+def receive_financial_data(request: AccountSnapshotRequest, requested_ccy):
+    financial_data = []
+    for entry in finbot_client.iter_financial_data(
+            provider=request.provider_id,
+            credentials_data=request.credentials_data,
+            line_items=request.line_items):
+        if "line_item" not in entry:
+            if "error" in entry:
+                return {"error": entry["error"]}
+            continue
+        logging.info(f"received '{entry['line_item']}' for account_id={request.account_id}")
+        if entry["line_item"] == "balances" and "results" in entry:
+            prefetch_xccy_rates(entry["results"], requested_ccy)
+        financial_data.append(entry)
+    return {"financial_data": financial_data}
+
+
+def dispatch_snapshot_entry(snapshot_id, request: AccountSnapshotRequest, requested_ccy):
     try:
         logging.info(f"starting snapshot for account_id={request.account_id}'"
                      f" provider_id={request.provider_id}")
 
-        finbot_client = FinbotClient(os.environ["FINBOT_FINBOTWSRV_ENDPOINT"])
-        account_snapshot = finbot_client.get_financial_data(
-            provider=request.provider_id,
-            credentials_data=request.credentials_data,
-            line_items=request.line_items)
+        with concurrency_governor.acquire(request.provider_id):
+            snapshot_progress.update(snapshot_id, request.account_id, LinkedAccountStatus.Processing)
+            account_snapshot = receive_financial_data(request, requested_ccy)
 
         logging.info(f"snapshot complete for for account_id={request.account_id}'"
                      f" provider_id={request.provider_id}")
 
+        snapshot_progress.update(
+            snapshot_id, request.account_id,
+            LinkedAccountStatus.Failure if "error" in account_snapshot else LinkedAccountStatus.Success)
         return request, account_snapshot
     except Exception as e:
         trace = traceback.format_exc()
@@ -242,14 +312,22 @@ def dispatch_snapshot_entry(request: AccountSnapshotRequest):
                         f" provider_id={request.provider_id}"
                         f" error: {e}"
                         f" trace:\n{trace}")
-        return request, make_error(
-            user_message="error while taking account snapshot",
-            debug_message=str(e),
-            trace=trace)
+        snapshot_progress.update(snapshot_id, request.account_id, LinkedAccountStatus.Failure)
+        return request, {
+            "error": make_error(
+                user_message="error while taking account snapshot",
+                debug_message=str(e),
+                trace=trace)
+        }
 
 
-def take_raw_snapshot(user_account):
-    with ThreadPoolExecutor(max_workers=4) as executor:
+def iter_raw_snapshot(snapshot_id, user_account, requested_ccy):
+    """ Yield linked accounts raw snapshots as soon as they are taken
+    """
+    # global concurrency is bounded by the governor, this pool only needs to be
+    # large enough to queue all linked accounts requests at once
+    max_workers = max(1, min(len(user_account.linked_accounts), 32))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
         logging.info("initializing accounts snapshot requests")
         requests = [
             AccountSnapshotRequest(
@@ -268,90 +346,343 @@ def take_raw_snapshot(user_account):
             for account in user_account.linked_accounts
         ]
 
+        snapshot_progress.start(snapshot_id, requests)
         logging.info(f"starting snapshot with {len(requests)} request(s)")
-        snapshot_entries = executor.map(dispatch_snapshot_entry, requests)
-        logging.info("complete snapshot taken")
-
-        return [
-            {
+        futures = [
+            executor.submit(dispatch_snapshot_entry, snapshot_id, request, requested_ccy)
+            for request in requests
+        ]
+        for future in as_completed(futures):
+            request, account_snapshot = future.result()
+            yield {
                 "provider": request.provider_id,
                 "account_id": request.account_id,
                 "data": account_snapshot
             }
-            for request, account_snapshot in snapshot_entries
-        ]
-
+        logging.info("complete snapshot taken")
 
-@app.route("/snapshot/<user_account_id>/take", methods=["POST"])
-@request_handler()
-def take_snapshot(user_account_id):
-    logging.info(f"fetching user information for user account id {user_account_id}")
 
-    user_account = (db_session.query(UserAccount)
-                              .options(joinedload(UserAccount.linked_accounts))
-                              .options(joinedload(UserAccount.settings))
-                              .filter_by(id=user_account_id)
-                              .first())
+def get_user_account(user_account_id):
+    return (db_session.query(UserAccount)
+                      .options(joinedload(UserAccount.linked_accounts))
+                      .options(joinedload(UserAccount.settings))
+                      .filter_by(id=user_account_id)
+                      .first())
 
-    logging.info(f"starting snapshot for user account "
-                 f"linked to {len(user_account.linked_accounts)} external accounts")
 
+def create_blank_snapshot(user_account):
     requested_ccy = user_account.settings.valuation_ccy
     logging.info(f"requested valuation currency is {requested_ccy}")
 
     with db_session.persist(UserAccountSnapshot()) as new_snapshot:
         new_snapshot.status = SnapshotStatus.Processing
         new_snapshot.requested_ccy = requested_ccy
-        new_snapshot.user_account_id = user_account_id
+        new_snapshot.user_account_id = user_account.id
         new_snapshot.start_time = utils.now_utc()
+        new_snapshot.heartbeat_at = new_snapshot.start_time
 
+    snapshot_heartbeat.ensure_started()
     logging.info(f"blank snapshot {new_snapshot.id} created")
+    return new_snapshot
+
+
+def find_reference_entry_id(linked_account_id, content_hash, before_snapshot_id):
+    """ Entry holding the data of the last successful snapshot (taken before
+    'before_snapshot_id') of this linked account, if its content is the same
+    """
+    if content_hash is None:
+        return None
+    last_entry = (db_session.query(LinkedAccountSnapshotEntry)
+                            .filter_by(linked_account_id=linked_account_id)
+                            .filter_by(success=True)
+                            .filter(LinkedAccountSnapshotEntry.snapshot_id < before_snapshot_id)
+                            .order_by(LinkedAccountSnapshotEntry.snapshot_id.desc())
+                            .first())
+    if last_entry is None or last_entry.content_hash != content_hash:
+        return None
+    return last_entry.reference_entry_id or last_entry.id
+
+
+def replace_linked_account_entries(snapshot_id, linked_account_id, new_entry_id, root_entry_id):
+    """ Remove previous entries of a linked account in a (replayed)
+    snapshot. Entries of later snapshots referencing them are moved to
+    'root_entry_id'. Does not commit.
+    """
+    previous_entry_ids = [
+        entry_id
+        for (entry_id, ) in (db_session.query(LinkedAccountSnapshotEntry.id)
+                                       .filter_by(snapshot_id=snapshot_id)
+                                       .filter_by(linked_account_id=linked_account_id)
+                                       .filter(LinkedAccountSnapshotEntry.id != new_entry_id))
+    ]
+    if not previous_entry_ids:
+        return
+    (db_session.query(LinkedAccountSnapshotEntry)
+               .filter(LinkedAccountSnapshotEntry.reference_entry_id.in_(previous_entry_ids))
+               .update({LinkedAccountSnapshotEntry.reference_entry_id: root_entry_id},
+                       synchronize_session=False))
+    (db_session.query(LinkedAccountSnapshotEntry)
+               .filter(LinkedAccountSnapshotEntry.id.in_(previous_entry_ids))
+               .delete(synchronize_session=False))
+
+
+def write_raw_snapshot(snapshot, raw_snapshot, xccy_rates_getter: LazyXccyRatesGetter,
+                       archive_codec=None, replace=False):
+    """ Each linked account snapshot is persisted (in its own transaction)
+    as soon as it is taken, along with the cross currency rates it needs
+    and its archived raw data ('archive_codec'). When 'replace' is set,
+    entries previously written for the same linked accounts are replaced.
+    """
+    requested_ccy = snapshot.requested_ccy
+    snapshot_builder = SnapshotBuilderVisitor(
+        snapshot,
+        xccy_rates_getter,
+        requested_ccy)
+
+    for raw_account in raw_snapshot:
+        account_id = raw_account["account_id"]
+        logging.info(utils.pretty_dump(raw_account))
+
+        # single walk over the raw data: rows are only built once rates for
+        # all the linked account currencies are known
+        snapshot_tree = compile_snapshot_tree([raw_account])
+        new_xccy_rates = xccy_rates_getter.fetch_missing(snapshot_tree.get_xccys(requested_ccy))
+
+        # unchanged linked account: only reference the entry holding the data,
+        # values in the snapshot currency are derived from this snapshot rates
+        content_hash = compute_content_hash(raw_account["data"])
+        reference_entry_id = find_reference_entry_id(account_id, content_hash, snapshot.id)
+
+        new_entries = [
+            XccyRateSnapshotEntry(snapshot_id=snapshot.id, xccy_pair=str(xccy), rate=rate)
+            for xccy, rate in new_xccy_rates.items()
+        ]
+        if archive_codec:
+            new_entries.append(archive.make_archive_entry(snapshot.id, raw_account, archive_codec))
+
+        with db_session.persist_all(new_entries) as entries:
+            if reference_entry_id is not None:
+                snapshot_builder.results_count.total += 1
+                linked_account_entry = LinkedAccountSnapshotEntry(
+                    snapshot_id=snapshot.id,
+                    linked_account_id=account_id,
+                    success=True,
+                    content_hash=content_hash,
+                    reference_entry_id=reference_entry_id)
+                entries.append(linked_account_entry)
+            elif snapshot_tree.items_count >= bulk_write_threshold:
+                rows_collector = SnapshotRowsCollector(
+                    snapshot.id,
+                    xccy_rates_getter,
+                    requested_ccy,
+                    snapshot_builder.results_count)
+                snapshot_tree.accept(rows_collector)
+                linked_account_rows = rows_collector.linked_accounts[account_id]
+                linked_account_rows.row["content_hash"] = content_hash
+                linked_account_entry = None
+                linked_account_entry_id = write_linked_account_rows(db_session, linked_account_rows)
+            else:
+                snapshot_tree.accept(snapshot_builder)
+                linked_account_entry = snapshot_builder.take_linked_account_entry(account_id)
+                linked_account_entry.content_hash = content_hash
+                entries.append(linked_account_entry)
+
+            if replace:
+                if linked_account_entry is not None:
+                    db_session.add(linked_account_entry)
+                    db_session.flush()
+                    linked_account_entry_id = linked_account_entry.id
+                replace_linked_account_entries(
+                    snapshot.id, account_id,
+                    new_entry_id=linked_account_entry_id,
+                    root_entry_id=reference_entry_id or linked_account_entry_id)
+
+        if reference_entry_id is not None:
+            logging.info(f"linked account {account_id} unchanged since last snapshot,"
+                         f" referencing entry {reference_entry_id}")
+        logging.info(f"linked account {account_id} snapshot persisted")
+
+    return snapshot_builder.results_count
+
+
+def build_snapshot(user_account, new_snapshot):
+    xccy_rates_getter = LazyXccyRatesGetter(fx_rates)
+    results_count = write_raw_snapshot(
+        new_snapshot,
+        iter_raw_snapshot(new_snapshot.id, user_account, new_snapshot.requested_ccy),
+        xccy_rates_getter,
+        archive_codec=archive_codec)
 
-    raw_snapshot = take_raw_snapshot(user_account)
-    logging.info(utils.pretty_dump(raw_snapshot))
-
-    logging.info(f"collecting currency pairs from raw snapshot")
-
-    xccy_collector = XccyCollector(requested_ccy)
-    visit_snapshot_tree(raw_snapshot, xccy_collector)
-
-    logging.info("fetching cross currency rates for: "
-                 f"{', '.join(str(xccy) for xccy in xccy_collector.xccys)}")
+    with db_session.persist(new_snapshot):
+        new_snapshot.status = SnapshotStatus.Success
+        new_snapshot.end_time = utils.now_utc()
 
-    xccy_rates = {
-        xccy: fx.get_xccy_rate(xccy.domestic, xccy.foreign)
-        for xccy in xccy_collector.xccys
+    return results_count
+
+
+def replay_snapshot(snapshot):
+    """ Rebuild a snapshot linked accounts entries from its archived raw
+    data, using the cross currency rates stored with the snapshot (missing
+    rates are historical rates as of the snapshot start time)
+    """
+    xccy_rates_getter = LazyXccyRatesGetter(
+        fx_rates,
+        date=snapshot.start_time,
+        xccy_rates={
+            Xccy(entry.xccy_pair[:3], entry.xccy_pair[3:]): float(entry.rate)
+            for entry in snapshot.xccy_rates_entries
+        })
+    return write_raw_snapshot(
+        snapshot,
+        archive.iter_archived_raw_snapshot(db_session, snapshot.id),
+        xccy_rates_getter,
+        replace=True)
+
+
+def run_snapshot(user_account, new_snapshot):
+    try:
+        return build_snapshot(user_account, new_snapshot)
+    except Exception:
+        db_session.rollback()
+        with db_session.persist(new_snapshot):
+            new_snapshot.status = SnapshotStatus.Failure
+            new_snapshot.end_time = utils.now_utc()
+        raise
+    finally:
+        snapshot_progress.finish(new_snapshot.id)
+
+
+def run_snapshot_in_background(user_account_id, snapshot_id):
+    try:
+        user_account = get_user_account(user_account_id)
+        new_snapshot = (db_session.query(UserAccountSnapshot)
+                                  .filter_by(id=snapshot_id)
+                                  .first())
+        with time_elapsed():
+            run_snapshot(user_account, new_snapshot)
+        logging.info(f"background snapshot {snapshot_id} processed successfully")
+    except Exception as e:
+        logging.warning(f"background snapshot {snapshot_id} processed with error: {e}"
+                        f"\n{traceback.format_exc()}")
+    finally:
+        db_session.remove()
+
+
+def get_results_count(snapshot):
+    results_count = SnapshotResultsCount()
+    for entry in snapshot.linked_accounts_entries:
+        results_count.total += 1
+        if not entry.success:
+            results_count.failures += 1
+    return results_count
+
+
+def serialize_results_count(results_count: SnapshotResultsCount):
+    return {
+        "total": results_count.total,
+        "success": results_count.success,
+        "failures": results_count.failures
     }
 
-    logging.info(f"adding cross currency rates to snapshot")
 
-    with db_session.persist(new_snapshot):
-        new_snapshot.xccy_rates_entries.extend([
-            XccyRateSnapshotEntry(xccy_pair=str(xccy), rate=rate)
-            for xccy, rate in xccy_rates.items()
-        ])
+@app.route("/snapshot/<user_account_id>/take", methods=["POST"])
+@request_handler()
+def take_snapshot(user_account_id):
+    run_async = bool(int(request.args.get("async", 0)))
+    logging.info(f"fetching user information for user account id {user_account_id}")
 
-    logging.info("building final snapshot")
+    user_account = get_user_account(user_account_id)
+    if not user_account:
+        raise ApplicationError(f"user account '{user_account_id}' not found")
 
-    snapshot_builder = SnapshotBuilderVisitor(
-        new_snapshot, 
-        CachedXccyRatesGetter(xccy_rates), 
-        new_snapshot.requested_ccy)
+    logging.info(f"starting snapshot for user account "
+                 f"linked to {len(user_account.linked_accounts)} external accounts (async={run_async})")
+
+    new_snapshot = create_blank_snapshot(user_account)
+
+    if run_async:
+        snapshot_progress.start(new_snapshot.id, [])
+        background_executor.submit(
+            run_snapshot_in_background, user_account.id, new_snapshot.id)
+        return jsonify(utils.serialize({
+            "snapshot": {
+                "identifier": new_snapshot.id,
+                "status": new_snapshot.status.name,
+                "start_time": new_snapshot.start_time
+            }
+        }))
 
-    with db_session.persist(new_snapshot):
-        visit_snapshot_tree(raw_snapshot, snapshot_builder)
-        new_snapshot.status = SnapshotStatus.Success
-        new_snapshot.end_time = utils.now_utc()
+    results_count = run_snapshot(user_account, new_snapshot)
 
     return jsonify({
         "snapshot": {
             "identifier": new_snapshot.id,
             "start_time": new_snapshot.start_time.isoformat(),
             "end_time": new_snapshot.end_time.isoformat(),
-            "results_count": {
-                "total": snapshot_builder.results_count.total,
-                "success": snapshot_builder.results_count.success,
-                "failures": snapshot_builder.results_count.failures
-            }
+            "results_count": serialize_results_count(results_count)
+        }
+    })
+
+
+@app.route("/snapshot/<snapshot_id>/replay", methods=["POST"])
+@request_handler()
+def replay_archived_snapshot(snapshot_id):
+    snapshot = (db_session.query(UserAccountSnapshot)
+                          .options(joinedload(UserAccountSnapshot.xccy_rates_entries))
+                          .filter_by(id=snapshot_id)
+                          .first())
+    if not snapshot:
+        raise ApplicationError(f"snapshot '{snapshot_id}' not found")
+    if snapshot.status != SnapshotStatus.Success:
+        raise ApplicationError(f"snapshot '{snapshot_id}' is not finished ({snapshot.status.name})")
+
+    logging.info(f"replaying snapshot {snapshot.id} from archived raw data")
+    with time_elapsed():
+        results_count = replay_snapshot(snapshot)
+    if results_count.total == 0:
+        raise ApplicationError(f"no archived raw data for snapshot '{snapshot_id}'")
+
+    return jsonify({
+        "snapshot": {
+            "identifier": snapshot.id,
+            "results_count": serialize_results_count(results_count)
         }
     })
+
+
+@app.route("/snapshot/<snapshot_id>/status", methods=["GET"])
+@request_handler()
+def get_snapshot_status(snapshot_id):
+    snapshot = (db_session.query(UserAccountSnapshot)
+                          .options(joinedload(UserAccountSnapshot.linked_accounts_entries))
+                          .filter_by(id=snapshot_id)
+                          .first())
+    if not snapshot:
+        raise ApplicationError(f"snapshot '{snapshot_id}' not found")
+
+    if snapshot.status == SnapshotStatus.Processing:
+        if fail_stale_snapshots(snapshot.id):
+            db_session.refresh(snapshot)
+
+    linked_accounts = snapshot_progress.get(snapshot.id)
+    if linked_accounts is None:
+        linked_accounts = [
+            {
+                "linked_account_id": entry.linked_account_id,
+                "status": (LinkedAccountStatus.Success
+                           if entry.success
+                           else LinkedAccountStatus.Failure)
+            }
+            for entry in snapshot.linked_accounts_entries
+        ]
+
+    return jsonify(utils.serialize({
+        "snapshot": {
+            "identifier": snapshot.id,
+            "status": snapshot.status.name,
+            "start_time": snapshot.start_time,
+            "end_time": snapshot.end_time,
+            "results_count": serialize_results_count(get_results_count(snapshot)),
+            "linked_accounts": linked_accounts
+        }
+    }))
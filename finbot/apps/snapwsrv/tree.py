@@ -0,0 +1,245 @@
+from finbot.core.fx import Xccy
+from finbot.apps.snapwsrv.bulk import LinkedAccountRows, SubAccountRows
+from finbot.model import (
+    UserAccountSnapshot,
+    LinkedAccountSnapshotEntry,
+    SubAccountSnapshotEntry,
+    SubAccountItemSnapshotEntry,
+    SubAccountItemType
+)
+import hashlib
+import json
+
+
+class SnapshotTreeVisitor(object):
+    def visit_account(self, account, errors):
+        pass
+
+    def visit_sub_account(self, account, sub_account, balance):
+        pass
+
+    def visit_item(self, account, sub_account, item_type, item):
+        pass
+
+
+def _iter_errors(account_data):
+    if "error" in account_data:
+        yield {
+            "scope": "linked_account",
+            "error": account_data["error"]
+        }
+        return
+    for data_entry in account_data["financial_data"]:
+        if "error" in data_entry:
+            yield {
+                "scope": f"linked_account.{data_entry['line_item']}",
+                "error": data_entry["error"]
+            }
+
+
+class CompiledSnapshotTree(object):
+    """ Flattened raw snapshot, built in a single pass by
+    'compile_snapshot_tree'. Nodes are references to the raw snapshot data
+    (not copies): visitors must not modify them.
+    """
+    def __init__(self):
+        self.accounts = []  # (account, errors, [(sub_account, balance)], [(sub_account, item_type, [item])])
+        self.currencies = set()
+        self.items_count = 0
+
+    def get_xccys(self, target_ccy):
+        return {
+            Xccy(ccy, target_ccy)
+            for ccy in self.currencies
+            if ccy != target_ccy
+        }
+
+    def accept(self, visitor: SnapshotTreeVisitor):
+        for account, errors, sub_accounts, items in self.accounts:
+            visitor.visit_account(account, errors)
+            for sub_account, balance in sub_accounts:
+                visitor.visit_sub_account(account, sub_account, balance)
+            for sub_account, item_type, sub_account_items in items:
+                for item in sub_account_items:
+                    visitor.visit_item(account, sub_account, item_type, item)
+
+
+_ITEMS_LINE_ITEMS = {
+    "assets": SubAccountItemType.Asset,
+    "liabilities": SubAccountItemType.Liability
+}
+
+
+def compile_snapshot_tree(raw_snapshot):
+    """ Walk the raw snapshot once, collecting sub accounts currencies along
+    the way. Sub accounts (balances) are always visited before items.
+    """
+    tree = CompiledSnapshotTree()
+    for account in raw_snapshot:
+        real_account = {"id": account["account_id"], "provider": account["provider"]}
+        account_data = account["data"]
+        account_errors = list(_iter_errors(account_data))
+        sub_accounts = []
+        items = []
+        tree.accounts.append((real_account, account_errors, sub_accounts, items))
+        if account_errors:
+            continue
+        for entry in account_data["financial_data"]:
+            line_item = entry["line_item"]
+            if line_item == "balances":
+                for result in entry["results"]:
+                    sub_account = result["account"]
+                    tree.currencies.add(sub_account["iso_currency"])
+                    sub_accounts.append((sub_account, result["balance"]))
+                continue
+            item_type = _ITEMS_LINE_ITEMS.get(line_item)
+            if item_type is None:
+                continue
+            for result in entry["results"]:
+                sub_account_items = result[line_item]
+                items.append((result["account"], item_type, sub_account_items))
+                tree.items_count += len(sub_account_items)
+    return tree
+
+
+def compute_content_hash(account_data):
+    """ Canonical hash (sha256) of a linked account financial data, does not
+    depend on line items and sub accounts ordering. None if the linked
+    account snapshot failed (fully or partially).
+    """
+    if any(True for _ in _iter_errors(account_data)):
+        return None
+    canonical_data = [
+        {
+            "line_item": entry["line_item"],
+            "results": sorted(entry["results"], key=lambda result: str(result["account"]["id"]))
+        }
+        for entry in sorted(account_data["financial_data"], key=lambda entry: entry["line_item"])
+    ]
+    serialized_data = json.dumps(canonical_data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized_data.encode()).hexdigest()
+
+
+class SnapshotResultsCount(object):
+    def __init__(self, total=0, failures=0):
+        self.total = total
+        self.failures = failures
+
+    @property
+    def success(self):
+        return self.total - self.failures
+
+
+class SnapshotBuilderVisitor(SnapshotTreeVisitor):
+    def __init__(self,
+                 snapshot: UserAccountSnapshot,
+                 xccy_rates_getter,
+                 target_ccy):
+        self.snapshot = snapshot
+        self.xccy_rates_getter = xccy_rates_getter
+        self.target_ccy = target_ccy
+        self.linked_accounts = {}  # linked_account_id -> account
+        self.sub_accounts = {}  # link_account_id, sub_account_id -> sub_account
+        self.visited_accounts = set()
+        self.results_count = SnapshotResultsCount()
+
+    def visit_account(self, account, errors):
+        account_id = account["id"]
+        assert account_id not in self.visited_accounts
+        self.visited_accounts.add(account_id)
+        linked_account_entry = LinkedAccountSnapshotEntry(
+            snapshot_id=self.snapshot.id,
+            linked_account_id=account_id)
+        linked_account_entry.success = not bool(errors)
+        self.results_count.total += 1
+        if errors:
+            self.results_count.failures += 1
+            linked_account_entry.failure_details = errors
+        self.linked_accounts[account_id] = linked_account_entry
+
+    def take_linked_account_entry(self, account_id):
+        """ Detach a built linked account entry (and its sub accounts) from
+        the builder, so that it can be persisted and released
+        """
+        self.sub_accounts = {
+            key: sub_account
+            for key, sub_account in self.sub_accounts.items()
+            if key[0] != account_id
+        }
+        return self.linked_accounts.pop(account_id)
+
+    def visit_sub_account(self, account, sub_account, balance):
+        account_id = account["id"]
+        linked_account = self.linked_accounts[account_id]
+        sub_account_id = sub_account["id"]
+        assert sub_account_id not in self.sub_accounts
+        sub_account_entry = SubAccountSnapshotEntry(
+            sub_account_id=sub_account_id,
+            sub_account_ccy=sub_account["iso_currency"],
+            sub_account_description=sub_account["name"])
+        linked_account.sub_accounts_entries.append(sub_account_entry)
+        self.sub_accounts[(account_id, sub_account_id)] = sub_account_entry
+
+    def visit_item(self, account, sub_account, item_type, item):
+        linked_account_id = account["id"]
+        sub_account_id = sub_account["id"]
+        sub_account_entry = self.sub_accounts[(linked_account_id, sub_account_id)]
+        item_value = item["value"]
+        new_item = SubAccountItemSnapshotEntry(
+            item_type=item_type,
+            name=item["name"],
+            item_subtype=item["type"],
+            units=item.get("units"),
+            value_sub_account_ccy=item_value,
+            value_snapshot_ccy=item_value * self.xccy_rates_getter(
+                Xccy(sub_account["iso_currency"], self.target_ccy)))
+        sub_account_entry.items_entries.append(new_item)
+
+
+class SnapshotRowsCollector(SnapshotTreeVisitor):
+    """ Same as SnapshotBuilderVisitor, but builds plain rows (see
+    bulk.write_linked_account_rows) instead of ORM entities
+    """
+    def __init__(self, snapshot_id, xccy_rates_getter, target_ccy,
+                 results_count: SnapshotResultsCount):
+        self.snapshot_id = snapshot_id
+        self.xccy_rates_getter = xccy_rates_getter
+        self.target_ccy = target_ccy
+        self.results_count = results_count
+        self.linked_accounts = {}  # linked_account_id -> LinkedAccountRows
+
+    def visit_account(self, account, errors):
+        account_id = account["id"]
+        assert account_id not in self.linked_accounts
+        self.results_count.total += 1
+        if errors:
+            self.results_count.failures += 1
+        self.linked_accounts[account_id] = LinkedAccountRows({
+            "snapshot_id": self.snapshot_id,
+            "linked_account_id": account_id,
+            "success": not bool(errors),
+            "failure_details": errors or None
+        })
+
+    def visit_sub_account(self, account, sub_account, balance):
+        linked_account = self.linked_accounts[account["id"]]
+        sub_account_id = sub_account["id"]
+        assert sub_account_id not in linked_account.sub_accounts
+        linked_account.sub_accounts[sub_account_id] = SubAccountRows({
+            "sub_account_id": sub_account_id,
+            "sub_account_ccy": sub_account["iso_currency"],
+            "sub_account_description": sub_account["name"]
+        })
+
+    def visit_item(self, account, sub_account, item_type, item):
+        linked_account = self.linked_accounts[account["id"]]
+        item_value = item["value"]
+        linked_account.sub_accounts[sub_account["id"]].items.append({
+            "item_type": item_type,
+            "name": item["name"],
+            "item_subtype": item["type"],
+            "units": item.get("units"),
+            "value_sub_account_ccy": item_value,
+            "value_snapshot_ccy": item_value * self.xccy_rates_getter(
+                Xccy(sub_account["iso_currency"], self.target_ccy))
+        })
@@ -1,7 +1,9 @@
 from flask import jsonify, request
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from io import BytesIO
 import functools
+import gzip
 import logging
 import traceback
 import jsonschema
@@ -85,3 +87,45 @@ def request_handler(schema=None):
                         trace=traceback.format_exc())
         return handler
     return impl
+
+
+class GzipRequestMiddleware(object):
+    """ WSGI middleware decompressing gzip encoded request bodies
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", "").lower() == "gzip":
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            body = gzip.decompress(environ["wsgi.input"].read(length))
+            environ["wsgi.input"] = BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.wsgi_app(environ, start_response)
+
+
+def enable_compression(app, min_size=1024):
+    """ Accept gzip encoded request bodies and gzip responses (of at least
+    'min_size' bytes) for clients accepting it
+    """
+    app.wsgi_app = GzipRequestMiddleware(app.wsgi_app)
+
+    @app.after_request
+    def compress_response(response):
+        if (response.direct_passthrough
+                or response.is_streamed
+                or response.status_code < 200
+                or response.status_code >= 300
+                or "Content-Encoding" in response.headers
+                or "gzip" not in request.headers.get("Accept-Encoding", "").lower()):
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(gzip.compress(data))
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    return app
@@ -1,6 +1,7 @@
+from finbot.clients.transport import Transport, get_default_transport
+from contextlib import closing
 from enum import Enum
 import json
-import requests
 
 
 def json_dumps(data):
@@ -18,16 +19,17 @@ class Error(RuntimeError):
 
 
 class FinbotClient(object):
-    def __init__(self, server_endpoint):
+    def __init__(self, server_endpoint, transport: Transport = None):
         self.server_endpoint = server_endpoint
+        self.transport = transport or get_default_transport()
 
     def get_providers(self):
         endpoint = f"{self.server_endpoint}/providers"
-        return json.loads(requests.get(endpoint).content)
+        return json.loads(self.transport.get(endpoint).content)
 
     def get_financial_data(self, provider, credentials_data, line_items):
         endpoint = f"{self.server_endpoint}/financial_data"
-        response = requests.post(endpoint, json={
+        response = self.transport.post(endpoint, json_data={
             "provider": provider,
             "credentials": credentials_data,
             "items": [item.value for item in line_items]
@@ -35,3 +37,25 @@ class FinbotClient(object):
         if not response:
             raise Error(f"failure while getting financial data (code {response.status_code})")
         return json.loads(response.content)
+
+    def iter_financial_data(self, provider, credentials_data, line_items):
+        """ Streamed version of 'get_financial_data': yield the authentication
+        status first ({"auth": ..., "error": ...}), then each line item as
+        soon as it is ready on the server side
+        """
+        endpoint = f"{self.server_endpoint}/financial_data"
+        response = self.transport.post(endpoint, params={"stream": 1}, stream=True, json_data={
+            "provider": provider,
+            "credentials": credentials_data,
+            "items": [item.value for item in line_items]
+        })
+        if not response:
+            raise Error(f"failure while getting financial data (code {response.status_code})")
+        with closing(response):
+            if response.headers.get("Content-Type", "").startswith("application/json"):
+                # request rejected before streaming started
+                yield json.loads(response.content)
+                return
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
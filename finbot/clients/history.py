@@ -1,4 +1,4 @@
-import requests
+from finbot.clients.transport import Transport, get_default_transport
 import json
 
 
@@ -7,11 +7,14 @@ class Error(RuntimeError):
 
 
 class HistoryClient(object):
-    def __init__(self, server_endpoint):
+    def __init__(self, server_endpoint, transport: Transport = None):
         self.server_endpoint = server_endpoint
+        self.transport = transport or get_default_transport()
 
-    def write_history(self, snapshot_id):
-        response = requests.post(f"{self.server_endpoint}/history/{snapshot_id}/write")
+    def write_history(self, snapshot_id, pipeline=None):
+        params = None if pipeline is None else {"pipeline": int(pipeline)}
+        response = self.transport.post(f"{self.server_endpoint}/history/{snapshot_id}/write",
+                                       params=params)
         if not response:
             raise Error(f"failure while writing history (code {response.status_code})")
         return json.loads(response.content)
@@ -1,5 +1,7 @@
-import requests
+from finbot.clients.transport import Transport, get_default_transport
+from datetime import datetime, timedelta
 import json
+import time
 
 
 class Error(RuntimeError):
@@ -7,11 +9,59 @@ class Error(RuntimeError):
 
 
 class SnapClient(object):
-    def __init__(self, server_endpoint):
+    def __init__(self, server_endpoint, transport: Transport = None):
         self.server_endpoint = server_endpoint
+        self.transport = transport or get_default_transport()
 
     def take_snapshot(self, account_id):
-        response = requests.post(f"{self.server_endpoint}/snapshot/{account_id}/take")
+        response = self.transport.post(f"{self.server_endpoint}/snapshot/{account_id}/take")
         if not response:
             raise Error(f"failure while taking snapshot (code {response.status_code})")
         return json.loads(response.content)
+
+    def take_snapshot_async(self, account_id):
+        response = self.transport.post(f"{self.server_endpoint}/snapshot/{account_id}/take",
+                                       params={"async": 1})
+        if not response:
+            raise Error(f"failure while taking snapshot (code {response.status_code})")
+        data = json.loads(response.content)
+        if "error" in data:
+            raise Error(f"failure while taking snapshot: {data['error']['debug_message']}")
+        return data
+
+    def replay_snapshot(self, snapshot_id):
+        response = self.transport.post(f"{self.server_endpoint}/snapshot/{snapshot_id}/replay")
+        if not response:
+            raise Error(f"failure while replaying snapshot (code {response.status_code})")
+        data = json.loads(response.content)
+        if "error" in data:
+            raise Error(f"failure while replaying snapshot: {data['error']['debug_message']}")
+        return data
+
+    def get_snapshot_status(self, snapshot_id):
+        response = self.transport.get(f"{self.server_endpoint}/snapshot/{snapshot_id}/status")
+        if not response:
+            raise Error(f"failure while getting snapshot status (code {response.status_code})")
+        data = json.loads(response.content)
+        if "error" in data:
+            raise Error(f"failure while getting snapshot status: {data['error']['debug_message']}")
+        return data
+
+    def wait_snapshot(self, snapshot_id, timeout: timedelta = None,
+                      poll_interval: timedelta = timedelta(seconds=5)):
+        """ Poll snapshot status until the snapshot is finished, return the
+        final status
+
+        :raises Error: snapshot failed or was not finished before timeout
+        """
+        deadline = (datetime.now() + timeout) if timeout else None
+        while True:
+            status = self.get_snapshot_status(snapshot_id)
+            snapshot_status = status["snapshot"]["status"]
+            if snapshot_status == "Success":
+                return status
+            if snapshot_status == "Failure":
+                raise Error(f"snapshot {snapshot_id} failed")
+            if deadline and datetime.now() >= deadline:
+                raise Error(f"snapshot {snapshot_id} not finished after {timeout}")
+            time.sleep(poll_interval.total_seconds())
@@ -0,0 +1,74 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import requests
+import gzip
+import json
+import os
+
+
+class Transport(object):
+    """ HTTP transport shared by finbot services clients: keep-alive
+    connection pool, connect / read timeouts, retries with exponential
+    backoff (connection errors for all requests, read errors and 502 / 503 /
+    504 responses for idempotent requests only) and gzip compressed request
+    and response bodies.
+    """
+    def __init__(self, pool_size=32, connect_timeout=5.0, read_timeout=600.0,
+                 retries=3, backoff_factor=0.5, compress_min_size=1024):
+        self.timeout = (connect_timeout, read_timeout)
+        self.compress_min_size = compress_min_size
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip"
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, json_data=None, params=None, stream=False):
+        headers = {}
+        data = None
+        if json_data is not None:
+            data = json.dumps(json_data).encode()
+            headers["Content-Type"] = "application/json"
+            if self.compress_min_size is not None and len(data) >= self.compress_min_size:
+                data = gzip.compress(data)
+                headers["Content-Encoding"] = "gzip"
+        return self.session.request(
+            method, url,
+            data=data,
+            params=params,
+            headers=headers,
+            timeout=self.timeout,
+            stream=stream)
+
+    def get(self, url, params=None, stream=False):
+        return self.request("GET", url, params=params, stream=stream)
+
+    def post(self, url, json_data=None, params=None, stream=False):
+        return self.request("POST", url, json_data=json_data, params=params, stream=stream)
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport() -> Transport:
+    """ Process-wide transport, configured with FINBOT_HTTP_* environment
+    variables
+    """
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = Transport(
+                pool_size=int(os.environ.get("FINBOT_HTTP_POOL_SIZE", 32)),
+                connect_timeout=float(os.environ.get("FINBOT_HTTP_CONNECT_TIMEOUT", 5)),
+                read_timeout=float(os.environ.get("FINBOT_HTTP_READ_TIMEOUT", 600)),
+                retries=int(os.environ.get("FINBOT_HTTP_RETRIES", 3)))
+        return _default_transport
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from datetime import timedelta
+import threading
+import time
+
+
+class TTLCache(object):
+    """ Thread-safe key/value cache where each entry expires after 'ttl'.
+    When 'max_size' is reached, least recently used entries are evicted.
+    """
+    def __init__(self, ttl: timedelta, max_size=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl: timedelta = None):
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl.total_seconds(), value)
+            self._entries.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,34 +1,250 @@
+from dataclasses import dataclass
+from collections import Counter, defaultdict
+from typing import Dict, Iterable
+from datetime import date as date_type, datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
+import bisect
 import json
-import shelve
+import csv
+import os
 
 
 API_URL = "https://api.exchangeratesapi.io"
 
 
-def get_xccy_rate(domestic_ccy, foreign_ccy, date=None):
-    def get_fx_rate_impl(home_ccy, foreign_ccy):
-        if home_ccy == foreign_ccy:
-            return 1.0
-        date_str = date.strftime("%Y-%m-%d") if date else "latest"
-        response = requests.get(
-            f"{API_URL}/{date_str}?base={domestic_ccy.upper()}&symbols={foreign_ccy.upper()}")
+@dataclass(frozen=True, eq=True)
+class Xccy(object):
+    domestic: str
+    foreign: str
+
+    def __str__(self):
+        return f"{self.domestic}{self.foreign}"
+
+
+class FxSource(object):
+    """ Provider of FX rates, 'rate' being the number of units of quote
+    currency for one unit of base currency
+    """
+    name = None
+
+    def get_rates(self, base_ccy, symbols, date=None) -> Dict[str, float]:
+        """ Return 'symbol -> rate' for all requested symbols against the base
+        currency at 'date' (spot rates when not provided)
+        """
+        raise NotImplementedError()
+
+    def get_historical_rates(self, base_ccy, symbols, start_date, end_date):
+        """ Return 'date -> symbol -> rate' for all requested symbols against
+        the base currency between 'start_date' and 'end_date' (inclusive)
+        """
+        raise NotImplementedError()
+
+
+def _format_symbols(symbols):
+    return ",".join(sorted(symbol.upper() for symbol in symbols))
+
+
+class HttpFxSource(FxSource):
+    """ Rates API (exchangeratesapi.io compatible) accessed through a pooled
+    session, with timeouts and retries (exponential backoff)
+    """
+    name = "exchangeratesapi.io"
+
+    def __init__(self, api_url=API_URL, timeout=10.0, retries=3, backoff_factor=0.5):
+        self.api_url = api_url
+        self.timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504]))
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _get(self, path, params):
+        response = self._session.get(f"{self.api_url}/{path}", params=params, timeout=self.timeout)
         data = json.loads(response.content.decode())
         if "error" in data:
             raise RuntimeError(data["error"])
-        return float(data["rates"][foreign_ccy.upper()])
-    return get_fx_rate_impl(domestic_ccy, foreign_ccy)
-
-
-def get_xccy_rate_cached(domestic_ccy, foreign_ccy, date=None):
-    date_str = date.strftime("%Y-%m-%d") if date else "latest"
-    cache_key = f"{date_str}/{domestic_ccy}/{foreign_ccy}"
-    with shelve.open('/tmp/get_xccy_rate_cached') as db:
-        if cache_key in db:
-            return db[cache_key]
-        rate = get_xccy_rate(domestic_ccy, foreign_ccy, date)
-        if date is None:
-            # no cache for spot
+        return data
+
+    def get_rates(self, base_ccy, symbols, date=None):
+        date_str = date.strftime("%Y-%m-%d") if date else "latest"
+        data = self._get(date_str, {
+            "base": base_ccy.upper(),
+            "symbols": _format_symbols(symbols)
+        })
+        return {symbol: float(rate) for symbol, rate in data["rates"].items()}
+
+    def get_historical_rates(self, base_ccy, symbols, start_date, end_date):
+        data = self._get("history", {
+            "base": base_ccy.upper(),
+            "symbols": _format_symbols(symbols),
+            "start_at": start_date.strftime("%Y-%m-%d"),
+            "end_at": end_date.strftime("%Y-%m-%d")
+        })
+        return {
+            datetime.strptime(date_str, "%Y-%m-%d").date(): {
+                symbol: float(rate)
+                for symbol, rate in rates.items()
+            }
+            for date_str, rates in data["rates"].items()
+        }
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+class FileFxSource(FxSource):
+    """ Rates loaded from a local CSV or Parquet file (no network access)
+    with 'date' (YYYY-MM-DD), 'base', 'quote' and 'rate' columns. The
+    nearest earlier rate is used when there is no rate at the requested
+    date, inverse and cross rates are derived from available pairs.
+    """
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+        self._rates = {}  # (base, quote) -> ([dates], [rates]), sorted by date
+        self._ccys = set()
+        self._dates = []
+        self._load(path)
+
+    @staticmethod
+    def _read_rows(path):
+        if os.path.splitext(path)[1].lower() == ".parquet":
+            import pandas as pd
+            for row in pd.read_parquet(path).itertuples(index=False):
+                yield str(row.date)[:10], row.base, row.quote, row.rate
+            return
+        with open(path, newline="") as rates_file:
+            for row in csv.DictReader(rates_file):
+                yield row["date"], row["base"], row["quote"], row["rate"]
+
+    def _load(self, path):
+        by_pair = defaultdict(list)
+        all_dates = set()
+        for date_str, base_ccy, quote_ccy, rate in self._read_rows(path):
+            date = datetime.strptime(date_str, "%Y-%m-%d").date()
+            by_pair[(base_ccy.upper(), quote_ccy.upper())].append((date, float(rate)))
+            all_dates.add(date)
+        for pair, entries in by_pair.items():
+            entries.sort()
+            self._rates[pair] = ([date for date, _ in entries], [rate for _, rate in entries])
+            self._ccys.update(pair)
+        self._dates = sorted(all_dates)
+
+    def _find(self, base_ccy, quote_ccy, date):
+        entries = self._rates.get((base_ccy, quote_ccy))
+        if entries is not None:
+            dates, rates = entries
+            index = bisect.bisect_right(dates, date)
+            if index > 0:
+                return rates[index - 1]
+        entries = self._rates.get((quote_ccy, base_ccy))
+        if entries is not None:
+            dates, rates = entries
+            index = bisect.bisect_right(dates, date)
+            if index > 0:
+                return 1.0 / rates[index - 1]
+        return None
+
+    def get_rate(self, base_ccy, quote_ccy, date=None):
+        base_ccy, quote_ccy = base_ccy.upper(), quote_ccy.upper()
+        date = _as_date(date) or date_type.max
+        if base_ccy == quote_ccy:
+            return 1.0
+        rate = self._find(base_ccy, quote_ccy, date)
+        if rate is not None:
             return rate
-        db[cache_key] = rate
-        return rate
+        for pivot_ccy in self._ccys:
+            pivot_base = self._find(pivot_ccy, base_ccy, date)
+            pivot_quote = self._find(pivot_ccy, quote_ccy, date)
+            if pivot_base is not None and pivot_quote is not None:
+                return pivot_quote / pivot_base
+        raise RuntimeError(f"no rate for {base_ccy}{quote_ccy} at {date} in {self.path}")
+
+    def get_rates(self, base_ccy, symbols, date=None):
+        return {
+            symbol.upper(): self.get_rate(base_ccy, symbol, date)
+            for symbol in symbols
+        }
+
+    def get_historical_rates(self, base_ccy, symbols, start_date, end_date):
+        start_index = bisect.bisect_left(self._dates, start_date)
+        end_index = bisect.bisect_right(self._dates, end_date)
+        return {
+            date: self.get_rates(base_ccy, symbols, date)
+            for date in self._dates[start_index:end_index]
+        }
+
+
+def create_source(spec=None) -> FxSource:
+    """ Build a FX source from its description: 'http' (default), or
+    'file:<path>' (CSV or Parquet rates file)
+    """
+    spec = spec or "http"
+    if spec == "http":
+        return HttpFxSource()
+    if spec.startswith("file:"):
+        return FileFxSource(spec[len("file:"):])
+    raise RuntimeError(f"unknown fx source: '{spec}'")
+
+
+_default_source = None
+
+
+def get_default_source() -> FxSource:
+    """ FX source configured through FINBOT_FX_SOURCE (see 'create_source')
+    """
+    global _default_source
+    if _default_source is None:
+        _default_source = create_source(os.environ.get("FINBOT_FX_SOURCE"))
+    return _default_source
+
+
+def get_xccy_rate(domestic_ccy, foreign_ccy, date=None, source: FxSource = None):
+    if domestic_ccy == foreign_ccy:
+        return 1.0
+    source = source or get_default_source()
+    return source.get_rates(domestic_ccy, [foreign_ccy], date)[foreign_ccy.upper()]
+
+
+def get_xccy_rates(xccys: Iterable[Xccy], date=None, source: FxSource = None) -> Dict[Xccy, float]:
+    """ Fetch rates for all requested currency pairs with a single request:
+    every currency is quoted against the most common currency amongst the
+    pairs (pivot) and other pairs are triangulated through the pivot
+    """
+    xccys = set(xccys)
+    rates = {
+        xccy: 1.0
+        for xccy in xccys
+        if xccy.domestic == xccy.foreign
+    }
+    pending = xccys - set(rates.keys())
+    if not pending:
+        return rates
+    source = source or get_default_source()
+    ccys = Counter()
+    for xccy in pending:
+        ccys.update([xccy.domestic.upper(), xccy.foreign.upper()])
+    pivot_ccy = ccys.most_common(1)[0][0]
+    pivot_rates = source.get_rates(pivot_ccy, set(ccys.keys()) - {pivot_ccy}, date)
+    pivot_rates[pivot_ccy] = 1.0
+    for xccy in pending:
+        domestic, foreign = xccy.domestic.upper(), xccy.foreign.upper()
+        for ccy in (domestic, foreign):
+            if ccy not in pivot_rates:
+                raise RuntimeError(f"no rate for {ccy} (base: {pivot_ccy})")
+        rates[xccy] = pivot_rates[foreign] / pivot_rates[domestic]
+    return rates
+
+
+def get_historical_rates(base_ccy, symbols, start_date, end_date, source: FxSource = None):
+    source = source or get_default_source()
+    return source.get_historical_rates(base_ccy, symbols, start_date, end_date)
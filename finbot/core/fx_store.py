@@ -0,0 +1,139 @@
+from finbot.core import fx
+from finbot.core.fx import Xccy
+from finbot.core.cache import TTLCache
+from finbot.model import FxRateEntry
+from sqlalchemy.dialects.postgresql import insert
+from datetime import date as date_type, datetime, timedelta
+from typing import Dict, Iterable
+import threading
+import logging
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+class FxRateStore(object):
+    """ Historical FX rates persisted in finbotdb (see 'backfill'), with an
+    in-process read-through cache. Historical rates missing from the
+    database are fetched from the FX source and persisted. Spot rates are
+    never persisted, they are cached for a short time ('spot_ttl') so that
+    concurrent snapshots share the same fetch.
+    """
+    def __init__(self, db_session, source: fx.FxSource = None, max_staleness=timedelta(days=7),
+                 spot_ttl=timedelta(minutes=1), cache_size=65536):
+        self.db_session = db_session
+        self.source = source or fx.get_default_source()
+        self.max_staleness = max_staleness
+        self._rates_cache = TTLCache(ttl=timedelta(days=1), max_size=cache_size)
+        self._spot_cache = TTLCache(ttl=spot_ttl)
+        self._spot_lock = threading.Lock()
+
+    def _lookup(self, base_ccy, quote_ccy, date):
+        """ Nearest rate at or before 'date' (within max staleness), served
+        by the (base_ccy, quote_ccy, date) primary key index
+        """
+        return (self.db_session.query(FxRateEntry.rate)
+                               .filter(FxRateEntry.base_ccy == base_ccy)
+                               .filter(FxRateEntry.quote_ccy == quote_ccy)
+                               .filter(FxRateEntry.date <= date)
+                               .filter(FxRateEntry.date > date - self.max_staleness)
+                               .order_by(FxRateEntry.date.desc())
+                               .limit(1)
+                               .scalar())
+
+    def _fetch_and_store(self, base_ccy, quote_ccy, date):
+        logging.info(f"fetching {base_ccy}{quote_ccy} rate for {date}")
+        rate = fx.get_xccy_rate(base_ccy, quote_ccy, date, self.source)
+        self.write_rates([(date, base_ccy, quote_ccy, rate)])
+        return rate
+
+    def get_rate(self, base_ccy, quote_ccy, date):
+        base_ccy, quote_ccy, date = base_ccy.upper(), quote_ccy.upper(), _as_date(date)
+        if base_ccy == quote_ccy:
+            return 1.0
+        cache_key = (base_ccy, quote_ccy, date)
+        rate = self._rates_cache.get(cache_key)
+        if rate is not None:
+            return rate
+        rate = self._lookup(base_ccy, quote_ccy, date)
+        if rate is None:
+            inverse_rate = self._lookup(quote_ccy, base_ccy, date)
+            if inverse_rate is not None:
+                rate = 1.0 / float(inverse_rate)
+        if rate is None:
+            rate = self._fetch_and_store(base_ccy, quote_ccy, date)
+        rate = float(rate)
+        self._rates_cache.put(cache_key, rate)
+        return rate
+
+    def get_spot_rates(self, xccys: Iterable[Xccy]) -> Dict[Xccy, float]:
+        with self._spot_lock:
+            rates = {}
+            missing = set()
+            for xccy in set(xccys):
+                rate = self._spot_cache.get(xccy)
+                if rate is None:
+                    missing.add(xccy)
+                else:
+                    rates[xccy] = rate
+            if missing:
+                for xccy, rate in fx.get_xccy_rates(missing, source=self.source).items():
+                    self._spot_cache.put(xccy, rate)
+                    rates[xccy] = rate
+            return rates
+
+    def get_xccy_rates(self, xccys: Iterable[Xccy], date=None) -> Dict[Xccy, float]:
+        if date is None:
+            return self.get_spot_rates(xccys)
+        return {
+            xccy: self.get_rate(xccy.domestic, xccy.foreign, date)
+            for xccy in set(xccys)
+        }
+
+    def write_rates(self, rates, source=None):
+        """ Insert or update (date, base_ccy, quote_ccy, rate) entries
+        """
+        source = source or self.source.name
+        rates = list(rates)
+        if not rates:
+            return 0
+        statement = insert(FxRateEntry.__table__).values([
+            {
+                "date": date,
+                "base_ccy": base_ccy.upper(),
+                "quote_ccy": quote_ccy.upper(),
+                "rate": rate,
+                "source": source
+            }
+            for (date, base_ccy, quote_ccy, rate) in rates
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=["base_ccy", "quote_ccy", "date"],
+            set_={
+                "rate": statement.excluded.rate,
+                "source": statement.excluded.source
+            })
+        self.db_session.execute(statement)
+        self.db_session.commit()
+        return len(rates)
+
+    def backfill(self, base_ccy, quote_ccys, start_date: date_type, end_date: date_type,
+                 chunk=timedelta(days=365)):
+        """ Bulk load historical rates, one request per chunk of dates
+        """
+        total = 0
+        chunk_start = start_date
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + chunk - timedelta(days=1), end_date)
+            logging.info(f"backfilling {base_ccy} rates from {chunk_start} to {chunk_end}")
+            history = self.source.get_historical_rates(base_ccy, quote_ccys, chunk_start, chunk_end)
+            total += self.write_rates(
+                (date, base_ccy, quote_ccy, rate)
+                for date, rates in history.items()
+                for quote_ccy, rate in rates.items())
+            chunk_start = chunk_end + timedelta(days=1)
+        self._rates_cache.clear()
+        return total
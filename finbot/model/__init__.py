@@ -2,15 +2,20 @@ from finbot.core.dbutils import JSONEncoded, DateTimeTz
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import (
+    DDL,
+    event,
     Column,
     Integer,
     String,
     Boolean,
     Numeric,
+    Date,
     Text,
+    LargeBinary,
     ForeignKey,
     ForeignKeyConstraint,
     UniqueConstraint,
+    Index,
     Enum,
     func
 )
@@ -106,6 +111,8 @@ class UserAccountSnapshot(Base):
     requested_ccy = Column(String(3), nullable=False)
     start_time = Column(DateTimeTz, index=True)
     end_time = Column(DateTimeTz, index=True)
+    # periodically refreshed by the snapwsrv process taking the snapshot
+    heartbeat_at = Column(DateTimeTz)
     created_at = Column(DateTimeTz, server_default=func.now())
     updated_at = Column(DateTimeTz, onupdate=func.now())
 
@@ -136,6 +143,21 @@ class XccyRateSnapshotEntry(Base):
         back_populates="xccy_rates_entries")
 
 
+class RawSnapshotArchiveEntry(Base):
+    """ Compressed raw financial data (as received from finbotwsrv) of a
+    linked account, see snapwsrv.archive
+    """
+    __tablename__ = "finbot_raw_snapshots_archive"
+    snapshot_id = Column(Integer, ForeignKey(UserAccountSnapshot.id, ondelete="CASCADE"), primary_key=True)
+    linked_account_id = Column(Integer, ForeignKey("finbot_linked_accounts.id", ondelete="CASCADE"), primary_key=True)
+    provider_id = Column(String(64), nullable=False)
+    codec = Column(String(16), nullable=False)
+    raw_size = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTimeTz, server_default=func.now())
+    updated_at = Column(DateTimeTz, onupdate=func.now())
+
+
 class LinkedAccountSnapshotEntry(Base):
     __tablename__ = "finbot_linked_accounts_snapshots"
     id = Column(Integer, primary_key=True)
@@ -143,6 +165,13 @@ class LinkedAccountSnapshotEntry(Base):
     linked_account_id = Column(Integer, ForeignKey("finbot_linked_accounts.id", ondelete="CASCADE"))
     success = Column(Boolean, nullable=False)
     failure_details = Column(JSONEncoded)
+    # canonical hash of the linked account financial data (successful entries
+    # only). An entry with the same content as the previous successful entry
+    # does not hold sub accounts: it references the entry holding them.
+    # Deleting a referenced entry promotes the earliest entry referencing it
+    # in its place (see promote_reference_function).
+    content_hash = Column(String(64))
+    reference_entry_id = Column(Integer, ForeignKey("finbot_linked_accounts_snapshots.id", ondelete="NO ACTION"))
     created_at = Column(DateTimeTz, server_default=func.now())
     updated_at = Column(DateTimeTz, onupdate=func.now())
 
@@ -154,6 +183,84 @@ class LinkedAccountSnapshotEntry(Base):
         "SubAccountSnapshotEntry", 
         back_populates="linked_account_entry")
 
+    __table_args__ = (
+        Index("idx_linked_accounts_snapshots_linked_account_id_snapshot_id",
+              linked_account_id, snapshot_id),
+    )
+
+
+# When a linked account snapshot entry referenced by later (unchanged) entries
+# is deleted, the earliest referencing entry is promoted in its place: sub
+# accounts are moved to it (values in the snapshot currency converted with its
+# snapshot rates) and other references are re-pointed to it. Nothing is
+# promoted when the whole linked account is being deleted.
+promote_reference_function = DDL("""
+CREATE OR REPLACE FUNCTION finbot_promote_linked_account_snapshot_reference() RETURNS trigger AS $$
+DECLARE
+    promoted_id integer;
+BEGIN
+    IF OLD.reference_entry_id IS NOT NULL
+       OR NOT EXISTS (SELECT 1 FROM finbot_linked_accounts WHERE id = OLD.linked_account_id) THEN
+        RETURN OLD;
+    END IF;
+
+    SELECT id INTO promoted_id
+    FROM finbot_linked_accounts_snapshots
+    WHERE reference_entry_id = OLD.id
+    ORDER BY snapshot_id, id
+    LIMIT 1;
+    IF promoted_id IS NULL THEN
+        RETURN OLD;
+    END IF;
+
+    UPDATE finbot_sub_accounts_items_snapshot_entries sais
+    SET value_snapshot_ccy = CASE
+            WHEN sase.sub_account_ccy = uas.requested_ccy
+            THEN sais.value_sub_account_ccy
+            ELSE sais.value_sub_account_ccy * xrs.rate
+        END
+    FROM finbot_sub_accounts_snapshot_entries sase
+    JOIN finbot_linked_accounts_snapshots las
+      ON las.id = promoted_id
+    JOIN finbot_user_accounts_snapshots uas
+      ON uas.id = las.snapshot_id
+    LEFT JOIN finbot_xccy_rates_snapshots xrs
+      ON xrs.snapshot_id = las.snapshot_id
+     AND xrs.xccy_pair = sase.sub_account_ccy || uas.requested_ccy
+    WHERE sais.sub_account_snapshot_entry_id = sase.id
+    AND sase.linked_account_snapshot_entry_id = OLD.id;
+
+    UPDATE finbot_sub_accounts_snapshot_entries
+    SET linked_account_snapshot_entry_id = promoted_id
+    WHERE linked_account_snapshot_entry_id = OLD.id;
+
+    UPDATE finbot_linked_accounts_snapshots
+    SET reference_entry_id = NULL
+    WHERE id = promoted_id;
+
+    UPDATE finbot_linked_accounts_snapshots
+    SET reference_entry_id = promoted_id
+    WHERE reference_entry_id = OLD.id;
+
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql
+""")
+promote_reference_trigger = DDL("""
+CREATE TRIGGER finbot_linked_accounts_snapshots_promote_reference
+BEFORE DELETE ON finbot_linked_accounts_snapshots
+FOR EACH ROW EXECUTE PROCEDURE finbot_promote_linked_account_snapshot_reference()
+""")
+drop_promote_reference_function = DDL("""
+DROP FUNCTION IF EXISTS finbot_promote_linked_account_snapshot_reference()
+""")
+event.listen(LinkedAccountSnapshotEntry.__table__, "after_create",
+             promote_reference_function.execute_if(dialect="postgresql"))
+event.listen(LinkedAccountSnapshotEntry.__table__, "after_create",
+             promote_reference_trigger.execute_if(dialect="postgresql"))
+event.listen(LinkedAccountSnapshotEntry.__table__, "after_drop",
+             drop_promote_reference_function.execute_if(dialect="postgresql"))
+
 
 class SubAccountSnapshotEntry(Base):
     __tablename__ = "finbot_sub_accounts_snapshot_entries"
@@ -248,6 +355,12 @@ class UserAccountHistoryEntry(Base):
         "SubAccountItemValuationHistoryEntry", 
         back_populates="account_valuation_history_entry")
 
+    __table_args__ = (
+        Index("idx_user_accounts_history_user_account_id_effective_at",
+              user_account_id, effective_at,
+              postgresql_where=available),
+    )
+
 
 class UserAccountValuationHistoryEntry(Base):
     __tablename__ = "finbot_user_accounts_valuation_history_entries"
@@ -369,3 +482,50 @@ class SubAccountItemValuationHistoryEntry(Base):
             ]
         ),
     )
+
+
+class WorkflowJobKind(enum.Enum):
+    Snapshot = 1  # take snapshot, then write history report
+
+
+class WorkflowJobState(enum.Enum):
+    Pending = 1
+    Running = 2
+    Done = 3
+    Failed = 4
+
+
+class WorkflowJob(Base):
+    __tablename__ = "finbot_workflow_jobs"
+    id = Column(Integer, primary_key=True)
+    user_account_id = Column(Integer, ForeignKey(UserAccount.id, ondelete="CASCADE"), nullable=False)
+    kind = Column(Enum(WorkflowJobKind), nullable=False)
+    state = Column(Enum(WorkflowJobState), nullable=False)
+    scheduled_at = Column(DateTimeTz, nullable=False)
+    lease_until = Column(DateTimeTz)
+    leased_by = Column(String(128))
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    finished_at = Column(DateTimeTz)
+    created_at = Column(DateTimeTz, server_default=func.now())
+    updated_at = Column(DateTimeTz, onupdate=func.now())
+
+    user_account = relationship(UserAccount, uselist=False)
+
+    __table_args__ = (
+        Index("idx_workflow_jobs_state_scheduled_at", state, scheduled_at),
+        Index("uidx_workflow_jobs_active_user_account_kind",
+              user_account_id, kind, unique=True,
+              postgresql_where=state.in_([WorkflowJobState.Pending, WorkflowJobState.Running])),
+    )
+
+
+class FxRateEntry(Base):
+    __tablename__ = "finbot_fx_rates"
+    base_ccy = Column(String(3), primary_key=True)
+    quote_ccy = Column(String(3), primary_key=True)
+    date = Column(Date, primary_key=True)
+    rate = Column(Numeric, nullable=False)
+    source = Column(String(64), nullable=False)
+    created_at = Column(DateTimeTz, server_default=func.now())
+    updated_at = Column(DateTimeTz, onupdate=func.now())
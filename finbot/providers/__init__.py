@@ -1,10 +1,28 @@
 from finbot.providers.support.selenium import DefaultBrowserFactory, SeleniumHelper
 from datetime import datetime
+import threading
 
 
 class Base(object):
+    # set when all line items are derived from the same (memoized) fetch:
+    # they are then served from a single 'get_financial_data' call
+    single_pass = False
+    # set when line items can be fetched concurrently from the same instance
+    # (not used for single pass providers)
+    concurrent_line_items = False
+
     def __init__(self, **kwargs):
-        pass
+        self._session_data = {}
+        self._session_data_lock = threading.Lock()
+
+    def _memoized(self, key, fetcher):
+        """ Return the result of 'fetcher', computed only once per provider
+        session (i.e. per Api instance)
+        """
+        with self._session_data_lock:
+            if key not in self._session_data:
+                self._session_data[key] = fetcher()
+            return self._session_data[key]
 
     def authenticate(self, credentials):
         """ Authenticate user with provided credentials. Should persist any
@@ -15,6 +33,31 @@ class Base(object):
         """
         pass
 
+    def restore_session(self, credentials, session_data) -> bool:
+        """ Optional: restore an authenticated session previously returned by
+        'export_session'. When True is returned, the session is considered
+        valid and 'authenticate' is not called.
+        """
+        return False
+
+    def export_session(self):
+        """ Optional: return (JSON serializable) data allowing to restore the
+        current authenticated session later on, None if not supported
+        """
+        return None
+
+    def get_financial_data(self):
+        """ Balances, assets and liabilities, formatted as:
+        {"balances": ..., "assets": ..., "liabilities": ...}
+        where each entry has the format returned by the corresponding
+        'get_balances', 'get_assets' and 'get_liabilities' method.
+        """
+        return {
+            "balances": self.get_balances(),
+            "assets": self.get_assets(),
+            "liabilities": self.get_liabilities()
+        }
+
     def get_balances(self):
         """
         """
@@ -41,12 +84,20 @@ class Base(object):
         pass
 
 
+def supports_single_pass(provider_api: Base):
+    return type(provider_api).single_pass
+
+
 class SeleniumBased(Base):
     def __init__(self, browser_factory=None, **kwargs):
         super().__init__(**kwargs)
-        browser_factory = browser_factory or DefaultBrowserFactory()
-        self.browser = browser_factory()
+        self._browser_factory = browser_factory or DefaultBrowserFactory()
+        self.browser = self._browser_factory()
         self._do = SeleniumHelper(self.browser)
 
     def close(self):
-        self.browser.quit()
+        release = getattr(self._browser_factory, "release", None)
+        if release:
+            release(self.browser)
+        else:
+            self.browser.quit()
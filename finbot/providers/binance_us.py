@@ -1,7 +1,6 @@
 from finbot import providers
 from finbot.providers.errors import AuthFailure
-from finbot.providers.support import CoinGeckoWrapper
-from pycoingecko import CoinGeckoAPI
+from finbot.providers.support import get_coingecko
 from binance.client import Client as Binance
 from binance.exceptions import BinanceAPIException
 
@@ -21,10 +20,12 @@ class Credentials(object):
 
 
 class Api(providers.Base):
+    single_pass = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._account_ccy = "USD"
-        self._spot_api = CoinGeckoWrapper(CoinGeckoAPI())
+        self._spot_api = get_coingecko()
         self._api = None
 
     def _account_description(self):
@@ -42,16 +43,21 @@ class Api(providers.Base):
             raise AuthFailure(str(e))
 
     def _iter_balances(self):
+        holdings = []
         for entry in self._api.get_account()["balances"]:
             units = float(entry["free"]) + float(entry["locked"])
             if units > 0.00001:
-                symbol = entry["asset"]
-                value = units * self._spot_api.get_spot_cached(
-                    symbol, self._account_ccy)
-                yield symbol, units, value
+                holdings.append((entry["asset"], units))
+        spots = self._spot_api.get_spots(
+            [symbol for symbol, _ in holdings], self._account_ccy)
+        for symbol, units in holdings:
+            yield symbol, units, units * spots[symbol]
+
+    def _get_balances_data(self):
+        return self._memoized("balances", lambda: list(self._iter_balances()))
 
     def get_balances(self):
-        balance = sum(value for (_, _, value) in self._iter_balances())
+        balance = sum(value for (_, _, value) in self._get_balances_data())
         return {
             "accounts": [
                 {
@@ -73,7 +79,7 @@ class Api(providers.Base):
                             "units": units,
                             "value": value
                         }
-                        for symbol, units, value in self._iter_balances()
+                        for symbol, units, value in self._get_balances_data()
                     ]
                 }
             ]
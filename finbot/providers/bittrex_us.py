@@ -1,7 +1,6 @@
 from finbot import providers
-from finbot.providers.support import CoinGeckoWrapper
+from finbot.providers.support import get_coingecko
 from finbot.providers.errors import AuthFailure
-from pycoingecko import CoinGeckoAPI
 from bittrex.bittrex import Bittrex
 
 
@@ -20,10 +19,12 @@ class Credentials(object):
 
 
 class Api(providers.Base):
+    single_pass = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._account_ccy = "USD"
-        self._spot_api = CoinGeckoWrapper(CoinGeckoAPI())
+        self._spot_api = get_coingecko()
         self._api = None
 
     def _account_description(self):
@@ -34,12 +35,14 @@ class Api(providers.Base):
         }
 
     def _iter_balances(self):
-        for entry in self._api.get_balances()["result"]:
-            symbol = entry["Currency"]
-            units = entry["Available"]
-            value = units * self._spot_api.get_spot_cached(
-                symbol, self._account_ccy)
-            yield symbol, units, value
+        holdings = [
+            (entry["Currency"], entry["Available"])
+            for entry in self._api.get_balances()["result"]
+        ]
+        spots = self._spot_api.get_spots(
+            [symbol for symbol, _ in holdings], self._account_ccy)
+        for symbol, units in holdings:
+            yield symbol, units, units * spots[symbol]
 
     def authenticate(self, credentials):
         self._api = Bittrex(credentials.api_key, credentials.private_key)
@@ -47,8 +50,11 @@ class Api(providers.Base):
         if not results["success"]:
             raise AuthFailure(results["message"])
 
+    def _get_balances_data(self):
+        return self._memoized("balances", lambda: list(self._iter_balances()))
+
     def get_balances(self):
-        balance = sum(value for (_, _, value) in self._iter_balances())
+        balance = sum(value for (_, _, value) in self._get_balances_data())
         return {
             "accounts": [
                 {
@@ -70,7 +76,7 @@ class Api(providers.Base):
                             "units": units,
                             "value": value
                         }
-                        for symbol, units, value in self._iter_balances()
+                        for symbol, units, value in self._get_balances_data()
                     ]
                 }
             ]
@@ -21,6 +21,8 @@ DUMMY_ACCOUNT = {
 
 
 class Api(providers.Base):
+    concurrent_line_items = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
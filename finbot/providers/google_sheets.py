@@ -22,6 +22,8 @@ class Credentials(object):
 
 
 class Api(providers.Base):
+    single_pass = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._api = None
@@ -55,6 +57,9 @@ class Api(providers.Base):
                 ]
             }
 
+    def _get_accounts(self):
+        return self._memoized("accounts", lambda: list(self._iter_accounts()))
+
     def authenticate(self, credentials: Credentials):
         scope = ['https://www.googleapis.com/auth/spreadsheets']
         self._api = gspread.authorize(
@@ -73,7 +78,7 @@ class Api(providers.Base):
                     },
                     "balance": sum(holding["value"] for holding in account["holdings"])
                 }
-                for account in self._iter_accounts()
+                for account in self._get_accounts()
             ]
         }
 
@@ -95,7 +100,7 @@ class Api(providers.Base):
                         for holding in account["holdings"]
                     ]
                 }
-                for account in self._iter_accounts()
+                for account in self._get_accounts()
             ]
         }
 
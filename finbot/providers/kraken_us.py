@@ -1,5 +1,7 @@
 from finbot import providers
 from finbot.providers.errors import AuthFailure
+from finbot.core.cache import TTLCache
+from datetime import timedelta
 import krakenex
 
 
@@ -18,6 +20,8 @@ class Credentials(object):
 
 
 class Api(providers.Base):
+    single_pass = True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._api = None
@@ -33,12 +37,15 @@ class Api(providers.Base):
     def _iter_balances(self):
         price_fetcher = KrakenPriceFetcher(self._api)
         results = self._api.query_private("Balance")["result"]
-        for symbol, units in results.items():
-            demangled_symbol = _format_symbol(symbol)
-            units = float(units)
-            if units > 0.0:
-                rate = price_fetcher.get_last_price(demangled_symbol, self._account_ccy)
-                yield symbol, units, units * rate
+        holdings = [
+            (symbol, float(units))
+            for symbol, units in results.items()
+            if float(units) > 0.0
+        ]
+        rates = price_fetcher.get_last_prices(
+            set(_format_symbol(symbol) for symbol, _ in holdings), self._account_ccy)
+        for symbol, units in holdings:
+            yield symbol, units, units * rates[_format_symbol(symbol)]
 
     def authenticate(self, credentials):
         self._api = krakenex.API(credentials.api_key, credentials.private_key)
@@ -46,8 +53,21 @@ class Api(providers.Base):
         if results["error"]:
             raise AuthFailure(_format_error(results["error"]))
 
+    def restore_session(self, credentials, session_data):
+        # keys were already validated, skip the authentication round trip
+        if not session_data.get("validated"):
+            return False
+        self._api = krakenex.API(credentials.api_key, credentials.private_key)
+        return True
+
+    def export_session(self):
+        return {"validated": True}
+
+    def _get_balances_data(self):
+        return self._memoized("balances", lambda: list(self._iter_balances()))
+
     def get_balances(self):
-        balance = sum(value for (_, _, value) in self._iter_balances())
+        balance = sum(value for (_, _, value) in self._get_balances_data())
         return {
             "accounts": [
                 {
@@ -71,7 +91,7 @@ class Api(providers.Base):
                         }
                     ]
                 }
-                for symbol, units, value in self._iter_balances()
+                for symbol, units, value in self._get_balances_data()
             ]
         }
 
@@ -90,17 +110,63 @@ def _format_symbol(symbol):
     return symbol[1:] if len(symbol) > 3 else symbol
 
 
+# shared by all Api instances (i.e. concurrent finbotwsrv requests)
+_asset_pairs_cache = TTLCache(ttl=timedelta(hours=12))
+_price_cache = TTLCache(ttl=timedelta(seconds=30), max_size=4096)
+
+
 class KrakenPriceFetcher(object):
+    """ Price crypto assets with a single (batched) Ticker request. Last
+    prices are kept for a short time in a process-wide cache.
+    """
     def __init__(self, kraken_api):
         self.api = kraken_api
 
-    def get_last_price(self, source_crypto_asset, target_ccy):
-        if source_crypto_asset == target_ccy:
-            return 1.0
-        pair = f"{source_crypto_asset}{target_ccy}"
-        results = self.api.query_public("Ticker", {
-            "pair": pair
-        })
+    def _query_public(self, method, data=None):
+        results = self.api.query_public(method, data)
         if results["error"]:
-            raise RuntimeError(f"{pair} " + _format_error(results["error"]))
-        return float(results["result"][list(results["result"].keys())[0]]["c"][0])
+            raise RuntimeError(f"{method} " + _format_error(results["error"]))
+        return results["result"]
+
+    def _get_asset_pairs(self):
+        """ Map pair alternate names (e.g. XBTEUR) to the pair names used as
+        keys in Ticker results (e.g. XXBTZEUR)
+        """
+        asset_pairs = _asset_pairs_cache.get("pairs")
+        if asset_pairs is None:
+            asset_pairs = {
+                pair_data["altname"]: pair_name
+                for pair_name, pair_data in self._query_public("AssetPairs").items()
+            }
+            _asset_pairs_cache.put("pairs", asset_pairs)
+        return asset_pairs
+
+    def get_last_prices(self, source_crypto_assets, target_ccy):
+        prices = {}
+        missing = {}  # pair name -> source asset
+        asset_pairs = None
+        for source_crypto_asset in source_crypto_assets:
+            if source_crypto_asset == target_ccy:
+                prices[source_crypto_asset] = 1.0
+                continue
+            price = _price_cache.get((source_crypto_asset, target_ccy))
+            if price is not None:
+                prices[source_crypto_asset] = price
+                continue
+            asset_pairs = asset_pairs or self._get_asset_pairs()
+            pair = f"{source_crypto_asset}{target_ccy}"
+            if pair not in asset_pairs:
+                raise RuntimeError(f"{pair} unknown asset pair")
+            missing[asset_pairs[pair]] = source_crypto_asset
+        if missing:
+            results = self._query_public("Ticker", {
+                "pair": ",".join(sorted(missing.keys()))
+            })
+            for pair_name, source_crypto_asset in missing.items():
+                price = float(results[pair_name]["c"][0])
+                _price_cache.put((source_crypto_asset, target_ccy), price)
+                prices[source_crypto_asset] = price
+        return prices
+
+    def get_last_price(self, source_crypto_asset, target_ccy):
+        return self.get_last_prices([source_crypto_asset], target_ccy)[source_crypto_asset]
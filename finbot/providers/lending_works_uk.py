@@ -9,6 +9,7 @@ import csv
 import io
 
 
+BASE_URL = "https://www.lendingworks.co.uk"
 AUTH_URL = "https://www.lendingworks.co.uk/sign-in"
 DASHBOARD_URL = "https://www.lendingworks.co.uk/lending-centre/{ns}"
 LOANS_EXPORT_URL = "https://www.lendingworks.co.uk/lending-centre/{ns}/my-loans/export"
@@ -124,6 +125,28 @@ class Api(providers.SeleniumBased):
         if "view" in isa_btn.text.lower():
             self._accounts[("ifisa", "ISA account")] = None
 
+    def restore_session(self, credentials, session_data):
+        self._do.get(BASE_URL)
+        for cookie in session_data["cookies"]:
+            self.browser.add_cookie(cookie)
+        account_type, _ = session_data["accounts"][0]
+        self._do.get(DASHBOARD_URL.format(ns=account_type))
+        if not self._do.find_many(By.CSS_SELECTOR, "body.logged-in"):
+            return False
+        self._accounts = {
+            tuple(account_key): None
+            for account_key in session_data["accounts"]
+        }
+        return True
+
+    def export_session(self):
+        if not self._accounts:
+            return None
+        return {
+            "cookies": self.browser.get_cookies(),
+            "accounts": list(self._accounts.keys())
+        }
+
     def get_balances(self):
         return {
             "accounts": [
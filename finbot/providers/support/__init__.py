@@ -1,23 +1,136 @@
-from functools import lru_cache
+from finbot.core.cache import TTLCache
 from pycoingecko import CoinGeckoAPI
+from datetime import timedelta
+import threading
+import tempfile
+import logging
+import json
+import time
+import os
 
 
 class CoinGeckoWrapper(object):
-    def __init__(self, coingecko_api: CoinGeckoAPI):
+    """ CoinGecko spot prices, meant to be shared by all providers in the
+    process (see 'get_coingecko'). The (large) symbol to coin id map is kept
+    on disk and refreshed periodically. Spot prices are fetched in batches
+    and cached for a short time.
+    """
+    def __init__(self, coingecko_api: CoinGeckoAPI, coins_list_path=None,
+                 coins_list_ttl=timedelta(days=1), spot_ttl=timedelta(minutes=1)):
         self._api = coingecko_api
-        self._symbols_to_id = {
-            entry["symbol"]: entry["id"]
-            for entry in self._api.get_coins_list()
-        }
+        self._coins_list_path = coins_list_path
+        self._coins_list_ttl = coins_list_ttl
+        self._symbols_to_id = None
+        self._symbols_loaded_at = None
+        self._symbols_lock = threading.Lock()
+        self._spot_cache = TTLCache(ttl=spot_ttl, max_size=4096)
+
+    def _read_coins_list(self, max_age=None):
+        path = self._coins_list_path
+        if not path or not os.path.isfile(path):
+            return None
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age.total_seconds():
+            return None
+        try:
+            with open(path) as coins_list_file:
+                return json.load(coins_list_file)
+        except Exception as e:
+            logging.warning(f"failed to read coins list from {path}: {e}")
+            return None
+
+    def _write_coins_list(self, coins_list):
+        path = self._coins_list_path
+        if not path:
+            return
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as coins_list_file:
+                json.dump(coins_list, coins_list_file)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"failed to write coins list to {path}: {e}")
+
+    def _load_coins_list(self):
+        coins_list = self._read_coins_list(max_age=self._coins_list_ttl)
+        if coins_list is not None:
+            return coins_list
+        try:
+            logging.info("downloading coingecko coins list")
+            coins_list = self._api.get_coins_list()
+        except Exception as e:
+            # fall back to stale copy (if any)
+            coins_list = self._read_coins_list()
+            if coins_list is None:
+                raise
+            logging.warning(f"failed to download coins list, using stale copy: {e}")
+            return coins_list
+        self._write_coins_list(coins_list)
+        return coins_list
+
+    def _get_symbols_to_id(self):
+        with self._symbols_lock:
+            now = time.monotonic()
+            if (self._symbols_to_id is None
+                    or now - self._symbols_loaded_at > self._coins_list_ttl.total_seconds()):
+                self._symbols_to_id = {
+                    entry["symbol"]: entry["id"]
+                    for entry in self._load_coins_list()
+                }
+                self._symbols_loaded_at = now
+            return self._symbols_to_id
+
+    def get_spots(self, source_crypto_ccys, target_ccy: str):
+        """ Return a source ccy -> spot price mapping (one request at most)
+        """
+        target_ccy = target_ccy.lower()
+        spots = {}
+        missing = {}  # coin id -> source ccy
+        symbols_to_id = None
+        for source_crypto_ccy in set(source_crypto_ccys):
+            spot = self._spot_cache.get((source_crypto_ccy.lower(), target_ccy))
+            if spot is not None:
+                spots[source_crypto_ccy] = spot
+                continue
+            symbols_to_id = symbols_to_id or self._get_symbols_to_id()
+            coin_id = symbols_to_id[source_crypto_ccy.lower()]
+            missing[coin_id] = source_crypto_ccy
+        if missing:
+            result = self._api.get_price(",".join(sorted(missing.keys())), target_ccy)
+            for coin_id, source_crypto_ccy in missing.items():
+                if coin_id not in result:
+                    raise RuntimeError(f"no spot for {coin_id}")
+                spot = result[coin_id][target_ccy]
+                self._spot_cache.put((source_crypto_ccy.lower(), target_ccy), spot)
+                spots[source_crypto_ccy] = spot
+        return spots
 
-    @lru_cache(None)
     def get_spot_cached(self, source_crypto_ccy: str, target_ccy: str):
-        return self.get_spot(source_crypto_ccy, target_ccy)
+        return self.get_spots([source_crypto_ccy], target_ccy)[source_crypto_ccy]
 
     def get_spot(self, source_crypto_ccy: str, target_ccy: str):
         target_ccy = target_ccy.lower()
-        coin_id = self._symbols_to_id[source_crypto_ccy.lower()]
+        coin_id = self._get_symbols_to_id()[source_crypto_ccy.lower()]
         result = self._api.get_price(coin_id, target_ccy)
         if coin_id not in result:
             raise RuntimeError(f"no spot for {coin_id}")
         return result[coin_id][target_ccy]
+
+
+_coingecko = None
+_coingecko_lock = threading.Lock()
+
+
+def get_coingecko() -> CoinGeckoWrapper:
+    global _coingecko
+    with _coingecko_lock:
+        if _coingecko is None:
+            _coingecko = CoinGeckoWrapper(
+                CoinGeckoAPI(),
+                coins_list_path=os.environ.get(
+                    "FINBOT_COINGECKO_CACHE_PATH",
+                    os.path.join(tempfile.gettempdir(), "finbot_coingecko_coins.json")),
+                coins_list_ttl=timedelta(seconds=int(
+                    os.environ.get("FINBOT_COINGECKO_COINS_LIST_TTL", 86400))),
+                spot_ttl=timedelta(seconds=int(
+                    os.environ.get("FINBOT_COINGECKO_SPOT_TTL", 60))))
+        return _coingecko
@@ -1,8 +1,12 @@
 from typing import List, Optional, Dict
 from functools import wraps
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
 from selenium.webdriver.support.expected_conditions import presence_of_element_located
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.remote.webelement import WebElement
+import threading
+import logging
 
 
 class DefaultBrowserFactory(object):
@@ -24,6 +28,247 @@ class DefaultBrowserFactory(object):
         driver = Chrome(options=opts)
         return driver
 
+    def release(self, browser):
+        browser.quit()
+
+
+def _get_browser_rss(browser):
+    """ Resident memory (bytes) used by the driver and browser processes,
+    None if it cannot be measured (psutil is optional)
+    """
+    try:
+        import psutil
+        process = psutil.Process(browser.service.process.pid)
+        return sum(
+            p.memory_info().rss
+            for p in [process] + process.children(recursive=True))
+    except Exception:
+        return None
+
+
+def _is_browser_healthy(browser):
+    try:
+        return browser.execute_script("return 1;") == 1
+    except Exception:
+        return False
+
+
+def _iter_frame_origins(frame_tree):
+    yield frame_tree["frame"].get("securityOrigin")
+    for child in frame_tree.get("childFrames", []):
+        yield from _iter_frame_origins(child)
+
+
+def _get_origin(url):
+    parts = urlparse(url)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        return None
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _get_visited_origins(browser):
+    """ Origins the current borrower may have stored data for: every origin
+    in the navigation history and frame tree of each tab, plus the domains
+    of all cookies set in the browser
+    """
+    origins = set()
+    for handle in browser.window_handles:
+        browser.switch_to.window(handle)
+        history = browser.execute_cdp_cmd("Page.getNavigationHistory", {})
+        origins.update(_get_origin(entry["url"]) for entry in history["entries"])
+        frame_tree = browser.execute_cdp_cmd("Page.getFrameTree", {})["frameTree"]
+        origins.update(_get_origin(origin) for origin in _iter_frame_origins(frame_tree) if origin)
+    for cookie in browser.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]:
+        domain = cookie["domain"].lstrip(".")
+        origins.update([f"https://{domain}", f"http://{domain}"])
+    origins.discard(None)
+    return origins
+
+
+def _reset_browser(browser):
+    """ Wipe any state left by the previous borrower: extra tabs, cookies,
+    cache and all storage (local, session, IndexedDB, service workers, ...)
+    of every origin it visited. Raises if any of the wiping commands fails,
+    in which case the browser must not be handed out again.
+    """
+    origins = _get_visited_origins(browser)
+    handles = browser.window_handles
+    for handle in handles[1:]:
+        browser.switch_to.window(handle)
+        browser.close()
+    browser.switch_to.window(handles[0])
+    browser.get("about:blank")
+    browser.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    browser.execute_cdp_cmd("Network.clearBrowserCache", {})
+    for origin in origins:
+        browser.execute_cdp_cmd("Storage.clearDataForOrigin", {
+            "origin": origin,
+            "storageTypes": "all"
+        })
+    if browser.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]:
+        raise RuntimeError("cookies survived browser reset")
+
+
+class _PooledBrowser(object):
+    def __init__(self, browser):
+        self.browser = browser
+        self.last_used = datetime.now()
+        self.uses = 0
+        self.initial_rss = _get_browser_rss(browser)
+
+
+class BrowserPool(object):
+    """ Pool of pre-started browsers, usable as a browser factory
+    (SeleniumBased providers call 'release' instead of quitting the browser).
+
+    Browsers are wiped between borrowers (and discarded when the wipe fails),
+    evicted after being idle for too long, recycled after a maximum number of
+    uses (or when their memory usage grew too much) and health-checked before
+    being handed out. The pool is refilled up to 'min_size' in the background
+    whenever browsers are evicted or discarded.
+    """
+    def __init__(self, browser_factory=None, max_size=4, min_size=0,
+                 max_idle_time=timedelta(minutes=10), max_uses=20,
+                 max_rss_growth=512 * 1024 * 1024):
+        self.browser_factory = browser_factory or DefaultBrowserFactory()
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.max_idle_time = max_idle_time
+        self.max_uses = max_uses
+        self.max_rss_growth = max_rss_growth
+        self._idle = []  # _PooledBrowser
+        self._leased = {}  # id(browser) -> _PooledBrowser
+        self._starting = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return len(self._idle) + len(self._leased) + self._starting
+
+    def _start_browser(self):
+        try:
+            return _PooledBrowser(self.browser_factory())
+        except Exception as e:
+            logging.warning(f"failed to start browser: {e}")
+            return None
+
+    @staticmethod
+    def _quit(entry: _PooledBrowser):
+        try:
+            entry.browser.quit()
+        except Exception as e:
+            logging.warning(f"failed to quit browser: {e}")
+
+    def _pop_idle_expired(self):
+        now = datetime.now()
+        expired = [entry for entry in self._idle
+                   if now - entry.last_used > self.max_idle_time]
+        self._idle = [entry for entry in self._idle if entry not in expired]
+        return expired
+
+    def _must_recycle(self, entry: _PooledBrowser):
+        if entry.uses >= self.max_uses:
+            return True
+        if entry.initial_rss is not None and self.max_rss_growth is not None:
+            current_rss = _get_browser_rss(entry.browser)
+            if current_rss is not None and current_rss - entry.initial_rss > self.max_rss_growth:
+                return True
+        return False
+
+    def warm_up(self):
+        """ Start browsers until the pool holds at least 'min_size' of them
+        """
+        while True:
+            with self._cond:
+                if self.size >= self.min_size:
+                    return
+                self._starting += 1
+            entry = self._start_browser()
+            with self._cond:
+                self._starting -= 1
+                if entry:
+                    self._idle.append(entry)
+                self._cond.notify()
+            if not entry:
+                return
+
+    def _refill(self):
+        """ Start browsers in the background to bring the pool back to
+        'min_size' (after browsers were evicted or discarded)
+        """
+        with self._cond:
+            if self.size >= self.min_size:
+                return
+        threading.Thread(target=self.warm_up, name="browser_pool_refill", daemon=True).start()
+
+    def evict_idle(self):
+        with self._cond:
+            expired = self._pop_idle_expired()
+        for entry in expired:
+            self._quit(entry)
+        if expired:
+            self._refill()
+
+    def __call__(self):
+        while True:
+            self.evict_idle()
+            with self._cond:
+                while not self._idle and self.size >= self.max_size:
+                    self._cond.wait()
+                entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    self._starting += 1
+            if entry is None:
+                entry = self._start_browser()
+                with self._cond:
+                    self._starting -= 1
+                    if entry:
+                        self._leased[id(entry.browser)] = entry
+                    self._cond.notify()
+                if entry is None:
+                    raise RuntimeError("unable to start browser")
+                return entry.browser
+            if not _is_browser_healthy(entry.browser):
+                logging.warning("discarding unhealthy pooled browser")
+                self._quit(entry)
+                with self._cond:
+                    self._cond.notify()
+                self._refill()
+                continue
+            with self._cond:
+                self._leased[id(entry.browser)] = entry
+            return entry.browser
+
+    def release(self, browser):
+        with self._cond:
+            entry = self._leased.pop(id(browser), None)
+        if entry is None:
+            browser.quit()
+            return
+        entry.uses += 1
+        entry.last_used = datetime.now()
+        keep = not self._must_recycle(entry)
+        if keep:
+            try:
+                _reset_browser(entry.browser)
+            except Exception as e:
+                logging.warning(f"failed to reset pooled browser: {e}")
+                keep = False
+        if not keep:
+            self._quit(entry)
+        with self._cond:
+            if keep:
+                self._idle.append(entry)
+            self._cond.notify()
+        if not keep:
+            self._refill()
+
+    def close(self):
+        with self._cond:
+            entries, self._idle = self._idle, []
+        for entry in entries:
+            self._quit(entry)
+
 
 def _safe_cond(cond):
     @wraps(cond)
@@ -0,0 +1,35 @@
+from finbot.core.cache import TTLCache
+from finbot.core import crypto
+from datetime import timedelta
+import hashlib
+import hmac
+import json
+
+
+class SessionCache(object):
+    """ Authenticated provider sessions (as exported by the provider
+    'export_session' hook), keyed by provider id and a hash of the
+    credentials. Sessions are only kept encrypted (fernet) in memory.
+    """
+    def __init__(self, secret, ttl=timedelta(minutes=30), max_size=1024):
+        self._secret = secret.encode() if isinstance(secret, str) else secret
+        self._sessions = TTLCache(ttl, max_size)
+
+    def _key(self, provider_id, credentials_data):
+        credentials_str = json.dumps(credentials_data, sort_keys=True)
+        digest = hmac.new(self._secret, credentials_str.encode(), hashlib.sha256)
+        return provider_id, digest.hexdigest()
+
+    def get(self, provider_id, credentials_data):
+        encrypted_session = self._sessions.get(self._key(provider_id, credentials_data))
+        if encrypted_session is None:
+            return None
+        return json.loads(crypto.fernet_decrypt(encrypted_session, self._secret).decode())
+
+    def put(self, provider_id, credentials_data, session_data):
+        self._sessions.put(
+            self._key(provider_id, credentials_data),
+            crypto.fernet_encrypt(json.dumps(session_data).encode(), self._secret))
+
+    def invalidate(self, provider_id, credentials_data):
+        self._sessions.invalidate(self._key(provider_id, credentials_data))